@@ -4,13 +4,19 @@ import click
 
 try:
     from core.swf_reader import SwfExporter
+    from core.swf_reader import CHROMEDRIVER_PATH
+    from utils.chrome_driver import BrowserPool
     from core.grf_reader import GrfTransformer
     from core.xml_reader import RecordXml
+    from core.xml_reader import RECORD_CACHE_FOLDER
     from core.grf_reader import MP4Merger
     from core.swf_reader import PngTransformer
     from core.movie_editor import MovieEditor
     from core.chat_editor import ChatEditor
     from core.final_merger import FinalMerger
+    from core.final_merger import FilterComplexMerger
+    from utils.artifact_store import ArtifactStore
+    from utils.artifact_store import artifact_store
 except:
     print('Please config the environment first.')
     import traceback
@@ -19,17 +25,33 @@ except:
     exit(1)
 
 
-def shutdown_server():
-    from utils.simple_server import httpd
-    if httpd:
-        httpd.shutdown()
-
-
 @click.group()
 def command():
     pass
 
 
+def cache_options(f):
+    # options of the commands which read record.xml or render swfs and pngs
+    f = click.option('--cache_dir', required=False, type=click.Path(file_okay=False, dir_okay=True),
+                     help='folder of parsed records and rendered artifacts, instead of ~/.3to1')(f)
+    f = click.option('--no_cache', is_flag=True, default=False,
+                     help='render everything, nothing is read from or written to the cache')(f)
+    return f
+
+
+def make_store(no_cache, cache_dir):
+    # artifact store of the cache options, None if nothing is stored
+    if no_cache:
+        return None
+    return ArtifactStore(os.path.join(cache_dir, 'artifacts')) if cache_dir else artifact_store
+
+
+def load_record(record_file, no_cache, cache_dir):
+    rx = RecordXml()
+    folder = os.path.join(cache_dir, 'records') if cache_dir else RECORD_CACHE_FOLDER
+    return rx.load(record_file, cache=not no_cache, folder=folder)
+
+
 @command.command(help='Convert swf to png')
 @click.option('-s', '--swf_file', required=True, type=click.Path(file_okay=True, dir_okay=False, exists=True),
               help='SWF file')
@@ -39,11 +61,11 @@ def command():
               default=SwfExporter().default_width, show_default=True)
 @click.option('-h', '--height', required=False, type=click.INT, help='Output png height',
               default=SwfExporter().default_height, show_default=True)
-def swf2png(swf_file, png_file, width, height):
+@cache_options
+def swf2png(swf_file, png_file, width, height, no_cache, cache_dir):
     if swf_file:
-        se = SwfExporter(default_width=width, default_height=height)
+        se = SwfExporter(default_width=width, default_height=height, store=make_store(no_cache, cache_dir))
         se(swf_file, to=png_file, width=width, height=height)
-        shutdown_server()
 
 
 @command.command(help='Convert swfs in record.xml to pngs')
@@ -54,25 +76,35 @@ def swf2png(swf_file, png_file, width, height):
               default=960, show_default=True)
 @click.option('--default_height', required=False, type=click.INT, help='default height to display swf',
               default=540, show_default=True)
-def record2pngs(record_file, swf_folder, png_folder, default_width, default_height):
+@click.option('--sessions', required=False, type=click.INT, help='chrome sessions rendering in parallel',
+              default=1, show_default=True)
+@click.option('--browser_only', is_flag=True, default=False,
+              help='render every swf by chrome, even those made of shapes only')
+@click.option('--workers', required=False, type=click.INT, help='processes rendering swfs made of shapes',
+              default=1, show_default=True)
+@cache_options
+def record2pngs(record_file, swf_folder, png_folder, default_width, default_height, sessions, browser_only,
+                workers, no_cache, cache_dir):
     if record_file and swf_folder:
-        rx = RecordXml()
-        rx.read(record_file)
-        rx.parse()
+        rx = load_record(record_file, no_cache, cache_dir)
         swfs = rx.swfs
         # output
         output_folder = swf_folder if not png_folder else png_folder
-        se = SwfExporter(default_width=default_width, default_height=default_height)
-        with click.progressbar(swfs, length=len(swfs), label='Converting') as swfs:
-            for swf in swfs:
-                content = swf['content']
-                ufilename = swf['ufilename']
-                width = swf['width']
-                height = swf['height']
-                grf_filename = os.path.join(swf_folder, content)
-                png_filename = os.path.join(output_folder, ufilename[:ufilename.rindex('.')] + '.png')
-                se(grf_filename, to=png_filename, width=width, height=height)
-        shutdown_server()
+        items = []
+        for swf in swfs:
+            content = swf['content']
+            ufilename = swf['ufilename']
+            width = swf['width']
+            height = swf['height']
+            grf_filename = os.path.join(swf_folder, content)
+            png_filename = os.path.join(output_folder, ufilename[:ufilename.rindex('.')] + '.png')
+            items.append((grf_filename, png_filename, width, height))
+        # browsers are started once and reused by all pages
+        with BrowserPool(CHROMEDRIVER_PATH, sessions) as pool:
+            se = SwfExporter(default_width=default_width, default_height=default_height, pool=pool,
+                             fast_path=not browser_only, workers=workers, store=make_store(no_cache, cache_dir))
+            with click.progressbar(length=len(items), label='Converting') as bar:
+                se.export_all(items, callback=lambda x: bar.update(1))
 
 
 @command.command(help='Covert grf to mp4')
@@ -93,9 +125,10 @@ def grf2mp4(grf_file, mp4_file):
               help='PNG file')
 @click.option('-d', '--duration', required=False, type=click.STRING,
               help='Video duration (unit: second)', default='1', show_default=True)
-def png2mp4(png_file, mp4_file, duration):
+@cache_options
+def png2mp4(png_file, mp4_file, duration, no_cache, cache_dir):
     if png_file:
-        pt = PngTransformer()
+        pt = PngTransformer(store=make_store(no_cache, cache_dir))
         pt(png_file, mp4_file, duration)
 
 
@@ -103,15 +136,22 @@ def png2mp4(png_file, mp4_file, duration):
 @click.option('-r', '--record_file', required=True, type=click.Path(file_okay=True, dir_okay=False, exists=True))
 @click.option('-p', '--png_folder', required=True, type=click.Path(file_okay=False, dir_okay=True, exists=True))
 @click.option('-m', '--mp4_folder', required=False, type=click.Path(file_okay=False, dir_okay=True, exists=True))
-def pngs2mp4s(record_file, png_folder, mp4_folder):
+@click.option('-o', '--output', required=False, type=click.Path(file_okay=True, dir_okay=False),
+              help='encode all pages to this ONE mp4 file, instead of one mp4 file per page')
+@cache_options
+def pngs2mp4s(record_file, png_folder, mp4_folder, output, no_cache, cache_dir):
     if record_file and png_folder:
-        rx = RecordXml()
-        rx.read(record_file)
-        rx.parse()
+        rx = load_record(record_file, no_cache, cache_dir)
         swfs = rx.swfs
         output_folder = png_folder if not mp4_folder else png_folder
         # pt
-        pt = PngTransformer()
+        pt = PngTransformer(store=make_store(no_cache, cache_dir))
+        if output:
+            # single encode of the whole slide track, mergemp4s --source swf is not needed
+            pages = list(map(lambda x: (os.path.join(png_folder, x['ufilename'].replace('.swf', '.png')),
+                                        abs(float(x['stoptimestamp']) - float(x['starttimestamp']))), swfs))
+            pt.encode_track(pages, output)
+            return
         with click.progressbar(swfs, length=len(swfs), label='Converting...') as swfs:
             for swf in swfs:
                 # png file comes from swf file
@@ -136,13 +176,13 @@ def pngs2mp4s(record_file, png_folder, mp4_folder):
 def record2mp4s(record_file, grf_folder, mp4_folder):
     if record_file and grf_folder:
         rx = RecordXml()
-        rx.read(record_file)
-        rx.parse()
+        rx.load(record_file)
         grfs = rx.grfs
         # output folder
         output_folder = grf_folder if not mp4_folder else mp4_folder
         # gt
         gt = GrfTransformer()
+        gt.probe_all(list(map(lambda x: os.path.join(grf_folder, x['multimedia']), grfs)))
         with click.progressbar(grfs, length=len(grfs), label='Converting...') as grfs:
             for grf in grfs:
                 filename = grf['multimedia']
@@ -185,12 +225,17 @@ def mergemp4s(record_file, mp4_folder, output, source):
               help='resize width')
 @click.option('--resize_height', default=540, show_default=True, type=click.INT,
               help='resize height')
-def addannotation(mp4_file, anno_file, output, resize, resize_width, resize_height):
+@click.option('--stream_copy', is_flag=True, default=False, show_default=True,
+              help='Re-encode only annotated segments and stream copy the others, '
+                   'ignored when resizing or unless input is h264 yuv420p')
+@click.option('--workers', default=1, show_default=True, type=click.INT,
+              help='Render shards split at key frames in this many processes')
+def addannotation(mp4_file, anno_file, output, resize, resize_width, resize_height, stream_copy, workers):
     if mp4_file and anno_file:
         if not output:
             output = mp4_file[:mp4_file.rindex('.')] + "_anno.mp4"
         me = MovieEditor(mp4_file, output, resize_width if resize else None, resize_height if resize else None)
-        me.draw_anno_file(anno_file)
+        me.draw_anno_file(anno_file, stream_copy=stream_copy, workers=workers)
 
 
 @command.command(help='Convert chat xml file to mp4 file')
@@ -231,11 +276,24 @@ def chat2mp4(chat_file, width, height, fps, max_size, x_offset, y_offset, output
               help='output mp4 file')
 @click.option('-f', '--fps', type=click.INT, default=10, show_default=True,
               help='output mp4 video fps')
-def final(swf_mp4, grf_mp4, chat_mp4, output, fps):
+@click.option('--engine', type=click.Choice(['python', 'ffmpeg']), default='python', show_default=True,
+              help='compose frames in python, or in one ffmpeg process with filter_complex')
+@click.option('--queue_size', type=click.INT, default=8, show_default=True,
+              help='frames prefetched per input by the python engine, 0 to disable threads')
+@click.option('--max_memory', type=click.INT, default=512, show_default=True,
+              help='memory cap of prefetched frames (unit: MB)')
+def final(swf_mp4, grf_mp4, chat_mp4, output, fps, engine, queue_size, max_memory):
     if swf_mp4 and grf_mp4 and chat_mp4 and output:
-        fm = FinalMerger(swf_mp4, grf_mp4, chat_mp4, output, fps=fps)
+        if engine == 'ffmpeg':
+            fm = FilterComplexMerger(swf_mp4, grf_mp4, chat_mp4, output, fps=fps)
+        else:
+            fm = FinalMerger(swf_mp4, grf_mp4, chat_mp4, output, fps=fps,
+                             queue_size=queue_size, max_memory=max_memory)
         fm.merge()
         fm.close()
+        # which queue waited, e.g. a large consumer stall count of swf means decoding swf is the bottleneck
+        for name, (producer, consumer) in getattr(fm, 'stalls', {}).items():
+            click.echo('%s: producer stalls %d, consumer stalls %d' % (name, producer, consumer))
 
 
 if __name__ == '__main__':
@@ -0,0 +1 @@
+# makes core and utils importable by tests, like running bin/cli.py from the repo root
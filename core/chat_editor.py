@@ -1,11 +1,14 @@
+import os
 import random
 import re
 import textwrap
 
 import click
-from PIL import Image, ImageDraw, ImageFont
+import numpy as np
+from PIL import Image, ImageFont
 from moviepy.video.io.ffmpeg_writer import FFMPEG_VideoWriter
 
+from core.glyph_atlas import glyph_atlas
 from core.xml_reader import ChatXml, Chat
 from utils.path import get_abs_path
 from utils.timestamp import timestamp2frame
@@ -45,6 +48,20 @@ class ChatQueue(object):
         return self._queue
 
 
+class ChatLayout(object):
+    """
+    chat formatted, wrapped and measured once,
+    strip is the chat rendered in full panel width, created when it is drawn for the first time.
+    """
+
+    def __init__(self, lines, heights, y_offset):
+        self.lines = lines
+        self.heights = heights
+        # the same advance as ChatEditor._draw_text()
+        self.height = y_offset + sum(map(lambda x: x + y_offset, heights))
+        self.strip = None
+
+
 class ChatEditor(object):
     def __init__(self, width, height, filename, fps, maxsize, **kwargs):
         self._width = width
@@ -63,6 +80,11 @@ class ChatEditor(object):
         self._color_map = {}
         # max characters in one line
         self._max_characters = (self._width - self._x_offset) // self._font.size
+        # chat -> ChatLayout, only chats which may be shown are kept
+        self._layouts = {}
+        # chats on the last rendered panel and its raw frame
+        self._panel_chats = None
+        self._panel = None
 
     def init_color_map(self, chats):
         self._color_map = self.make_color_map(chats)
@@ -82,34 +104,38 @@ class ChatEditor(object):
 
     def draw_chat(self, chat, x, y) -> int:
         self._image = Image.new('RGB', (self._width, self._height), color=self._bg_color)
-        self._draw = ImageDraw.Draw(self._image)
         content = self._format_chat(chat)
         color = self.get_color_by_chat(chat)
-        y_pos = self._draw_text(self._draw, content, x, y, color=color)
+        y_pos = self._draw_text(self._image, content, x, y, color=color)
         self.write_frame(self._image)
         return y_pos
 
     def draw_chats(self, chats):
-        # draw all chats in chat queue
-        self._image = Image.new('RGB', (self._width, self._height), color=self._bg_color)
-        self._draw = ImageDraw.Draw(self._image)
-        x_pos, y_pos = 0, 0
-        for chat in chats:
-            content = self._format_chat(chat)
-            color = self.get_color_by_chat(chat)
-            y_pos = self._draw_text(self._draw, content, x_pos, y_pos, color=color)
-        self.write_frame(self._image)
+        # draw all chats in chat queue,
+        # the panel is rendered only when chats change, otherwise the last one is written again
+        if self._panel_chats != tuple(chats):
+            self._image = Image.new('RGB', (self._width, self._height), color=self._bg_color)
+            y_pos = 0
+            for chat in chats:
+                layout = self.get_layout(chat)
+                if layout.lines and y_pos < self._height:
+                    self._image.paste(self.get_strip(chat), (0, y_pos))
+                y_pos += layout.height
+            self._panel_chats = tuple(chats)
+            # drop layouts of chats which have left the queue
+            self._layouts = {chat: self._layouts[chat] for chat in chats}
+            self._panel = self._image.tobytes()
+        self.write_raw_frame(self._panel)
 
     def foresee_chats(self, chats):
         if not chats:
             return
         # ensure full content of chats to be shown in the video,
         # if not, remove the former chats
-        x_pos, y_pos = 0, 0
+        y_pos = 0
         remove_count = len(chats)
         for chat in chats[::-1]:
-            content = self._format_chat(chat)
-            y_pos = self._draw_text(self._draw, content, x_pos, y_pos, to_draw=False)
+            y_pos += self.get_layout(chat).height
             # y_pos > height, to remove chat
             if y_pos > self._height:
                 break
@@ -122,19 +148,47 @@ class ChatEditor(object):
     def write_frame(self, frame):
         self._writer.write_frame(frame)
 
+    def write_raw_frame(self, data):
+        # rgb24 bytes of one frame
+        self._writer.proc.stdin.write(data)
+
     def close(self):
         self._writer.close()
 
-    def _draw_text(self, draw, text, x, y, color=None, to_draw=True):
+    def _draw_text(self, image, text, x, y, color=None, to_draw=True):
         # refer: https://stackoverflow.com/questions/7698231/python-pil-draw-multiline-text-on-image
         lines = textwrap.wrap(text, width=self._max_characters)
         y_text = y + self._y_offset
         for line in lines:
-            width, height = self._font.getsize(line)
-            to_draw and draw.text((x + self._x_offset, y_text), line, font=self._font, fill=color or (0, 0, 0))
+            width, height = glyph_atlas.getsize(self._font, line)
+            to_draw and glyph_atlas.draw_text(image, (x + self._x_offset, y_text), line, self._font,
+                                              color or (0, 0, 0))
             y_text += height + self._y_offset
         return y_text
 
+    def get_layout(self, chat: Chat) -> ChatLayout:
+        layout = self._layouts.get(chat)
+        if layout is None:
+            content = self._format_chat(chat)
+            lines = textwrap.wrap(content, width=self._max_characters)
+            heights = list(map(lambda x: glyph_atlas.getsize(self._font, x)[1], lines))
+            layout = ChatLayout(lines, heights, self._y_offset)
+            self._layouts[chat] = layout
+        return layout
+
+    def get_strip(self, chat: Chat):
+        layout = self.get_layout(chat)
+        if layout.strip is None:
+            strip = np.empty((layout.height, self._width, 3), dtype='uint8')
+            strip[...] = self._bg_color
+            color = self.get_color_by_chat(chat)
+            y_text = self._y_offset
+            for line, height in zip(layout.lines, layout.heights):
+                glyph_atlas.draw_text(strip, (self._x_offset, y_text), line, self._font, color or (0, 0, 0))
+                y_text += height + self._y_offset
+            layout.strip = Image.fromarray(strip)
+        return layout.strip
+
     def _format_chat(self, chat: Chat):
         name = chat.sender
         content = self.format_chat_content(chat.content)
@@ -146,35 +200,38 @@ class ChatEditor(object):
     def format_chat_content(content):
         return clean_text(content)
 
+    def update_color_map(self, chat: Chat):
+        if chat.senderId not in self._color_map:
+            self._color_map[chat.senderId] = self.random_color()
+
+    @staticmethod
+    def random_color():
+        return (
+            random.randint(0, 255),
+            random.randint(0, 255),
+            random.randint(0, 255)
+        )
+
     @staticmethod
     def make_color_map(chats):
         all_sender_id = list(set(list(map(lambda x: x.senderId, chats))))
         color_map = {
-            _id: (
-                random.randint(0, 255),
-                random.randint(0, 255),
-                random.randint(0, 255)
-            )
+            _id: ChatEditor.random_color()
             for _id in all_sender_id
         }
         return color_map
 
     def draw(self, chat_filename):
         cx = ChatXml()
-        cx.read(chat_filename)
-        cx.parse()
+        # chats are streamed, so colors are assigned and total frame is known while reading
+        chats = cx.iter_chat(chat_filename)
 
-        chats = cx.chat
-
-        # init total frame
-        self.init_total_frame(cx.duration)
-
-        # init color map
-        self.init_color_map(chats)
-
-        with click.progressbar(length=self._total_frame, label='Processing...') as bar:
+        # progress of bytes read
+        with click.progressbar(length=os.path.getsize(chat_filename), label='Processing...') as bar:
             frame = 0
+            chat = None
             for chat in chats:
+                self.update_color_map(chat)
                 chat_frame = timestamp2frame(chat.timestamp, self._fps)
                 self.foresee_chats(self._chat_queue.get_all())
                 draw_chats = self._chat_queue.get_all()
@@ -182,18 +239,19 @@ class ChatEditor(object):
                 while frame < chat_frame:
                     self.draw_chats(draw_chats)
                     frame += 1
-                    bar.update(1)
                 # current
                 self._chat_queue.push(chat)
                 # forsee
                 self.foresee_chats(self._chat_queue.get_all())
                 self.draw_chats(self._chat_queue.get_all())
                 frame += 1
-                bar.update(1)
+                bar.update(cx.position - bar.pos)
+            # init total frame by the last chat
+            if chat:
+                self.init_total_frame(chat.timestamp)
+            # forsee
+            self.foresee_chats(self._chat_queue.get_all())
             # draw left
             while frame < self._total_frame:
-                # forsee
-                self.foresee_chats(self._chat_queue.get_all())
                 self.draw_chats(self._chat_queue.get_all())
                 frame += 1
-                bar.update(1)
@@ -1,12 +1,113 @@
+import queue
+import subprocess
+import threading
+
 import click
 import numpy as np
 from moviepy.video.io.ffmpeg_reader import FFMPEG_VideoReader
 from moviepy.video.io.ffmpeg_writer import FFMPEG_VideoWriter
 
 from core.grf_reader import FfmpegQuerier
+from core.grf_reader import FFMPEG_FILE
+from core.grf_reader import FFMPEG_LOGLEVEL
+
+
+def read_frame_into(reader, buffer) -> bool:
+    # read one raw frame of FFMPEG_VideoReader into buffer without allocation, False if the stream is exhausted
+    data = memoryview(buffer).cast('B')
+    n = reader.proc.stdout.readinto(data)
+    reader.pos += 1
+    return n == len(data)
+
+
+class FramePipe(object):
+    """
+    bounded queue of recycled frame buffers between a producer and a consumer thread.
+    stall counters tell which side waits for the other:
+    producer_stalls means the consumer is slow, consumer_stalls means the producer is slow.
+    """
+
+    def __init__(self, shape, depth):
+        self._free = queue.Queue()
+        self._filled = queue.Queue()
+        for _ in range(depth):
+            self._free.put(np.zeros(shape, dtype='uint8'))
+        self.producer_stalls = 0
+        self.consumer_stalls = 0
+
+    @staticmethod
+    def _get(q):
+        # (item, stalled)
+        try:
+            return q.get_nowait(), False
+        except queue.Empty:
+            return q.get(), True
+
+    # producer
+    def acquire(self):
+        buffer, stalled = self._get(self._free)
+        self.producer_stalls += stalled
+        return buffer
+
+    def publish(self, buffer):
+        # None means end of stream
+        self._filled.put(buffer)
+
+    # consumer
+    def get(self):
+        buffer, stalled = self._get(self._filled)
+        self.consumer_stalls += stalled
+        return buffer
+
+    def release(self, buffer):
+        self._free.put(buffer)
+
 
+class PrefetchReader(threading.Thread):
+    # decode frames of one input ahead of the compositor
+    def __init__(self, reader, pipe, max_frames):
+        super(PrefetchReader, self).__init__(daemon=True)
+        self._reader = reader
+        self._pipe = pipe
+        self._max_frames = max_frames
+        self.error = None
 
-class FinalMerger(object):
+    def run(self):
+        try:
+            for _ in range(self._max_frames):
+                buffer = self._pipe.acquire()
+                if not read_frame_into(self._reader, buffer):
+                    break
+                self._pipe.publish(buffer)
+        except Exception as e:
+            self.error = e
+        # end of stream
+        self._pipe.publish(None)
+
+
+class AsyncWriter(threading.Thread):
+    # write composed frames to FFMPEG_VideoWriter while the next ones are being composed
+    def __init__(self, writer, pipe):
+        super(AsyncWriter, self).__init__(daemon=True)
+        self._writer = writer
+        self._pipe = pipe
+        self.error = None
+
+    def run(self):
+        while True:
+            canvas = self._pipe.get()
+            if canvas is None:
+                break
+            # keep draining after an error, so that the compositor never blocks
+            if self.error is None:
+                try:
+                    self._writer.proc.stdin.write(memoryview(canvas).cast('B'))
+                except Exception as e:
+                    self.error = e
+            self._pipe.release(canvas)
+
+
+class BaseMerger(object):
     """
     merge 3 mp4 files to one mp4 file,
     in other words, 3to1.
@@ -26,13 +127,10 @@ class FinalMerger(object):
         self._grf_mp4 = grf_mp4
         self._chat_mp4 = chat_mp4
         self._fq = FfmpegQuerier()
-        self._swf_reader = FFMPEG_VideoReader(swf_mp4)
-        self._grf_reader = FFMPEG_VideoReader(grf_mp4)
-        self._chat_reader = FFMPEG_VideoReader(chat_mp4)
+        self._fq.probe_all([swf_mp4, grf_mp4, chat_mp4])
         self._output = output
         self._fps = fps
         self._output_size = self.cal_output_size()
-        self._writer = FFMPEG_VideoWriter(output, self._output_size, fps, audiofile=grf_mp4)
 
     def get_duration(self, filename) -> float:
         self._fq(filename)
@@ -42,16 +140,113 @@ class FinalMerger(object):
         self._fq(filename)
         return self._fq.size
 
+    @staticmethod
+    def _even(x):
+        return x + x % 2
+
+    def layout(self):
+        """
+        geometry shared by all engines, so that they make the same output from the same inputs.
+        :return: (output width, output height), {name: (x, y, width, height)} of swf, grf and chat
+        """
+        sw, sh = self.get_size(self._swf_mp4)
+        gw, gh = self.get_size(self._grf_mp4)
+        cw, ch = self.get_size(self._chat_mp4)
+        # chat is scaled to the width of grf if they differ
+        if cw != gw:
+            cw, ch = gw, self._even(int(round(ch * gw / float(cw))))
+        # libx264 with yuv420p needs even size, the rest of the canvas is black
+        size = self._even(sw + gw), self._even(max(sh, gh + ch))
+        return size, dict(swf=(0, 0, sw, sh), grf=(sw, 0, gw, gh), chat=(sw, gh, cw, ch))
+
     def cal_output_size(self):
-        swf_size = self.get_size(self._swf_mp4)
-        grf_size = self.get_size(self._grf_mp4)
-        return swf_size[0] + grf_size[0], swf_size[1]
+        return self.layout()[0]
+
+    def merge(self):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
 
-    def _merge_frame(self, swf_frame, grf_frame, chat_frame):
-        sf = swf_frame.astype('uint8')
-        gf = grf_frame.astype('uint8')
-        cf = chat_frame.astype('uint8')
-        return np.column_stack([sf, np.row_stack([gf, cf])])
+
+class FinalMerger(BaseMerger):
+    """
+    compose frames in python, each input is decoded by its own ffmpeg process.
+    """
+
+    def __init__(self, swf_mp4, grf_mp4, chat_mp4, output, fps=10, queue_size=8, max_memory=512):
+        """
+        :param queue_size: frames prefetched per input and queued for the encoder, 0 to merge without threads
+        :param max_memory: cap of all queued frames, unit: MB
+        """
+        super(FinalMerger, self).__init__(swf_mp4, grf_mp4, chat_mp4, output, fps=fps)
+        self._boxes = self.layout()[1]
+        self._swf_reader = FFMPEG_VideoReader(swf_mp4)
+        self._grf_reader = FFMPEG_VideoReader(grf_mp4)
+        # decoded at the size of its region, scaled by ffmpeg if needed
+        cw, ch = self._boxes['chat'][2:]
+        self._chat_reader = FFMPEG_VideoReader(chat_mp4, target_resolution=(ch, cw))
+        self._writer = FFMPEG_VideoWriter(output, self._output_size, fps, audiofile=grf_mp4)
+        self._queue_size = queue_size
+        self._max_memory = max_memory * 1024 * 1024
+        self._canvas = None
+        self._inputs = []
+        self._pipes = {}
+
+    def _regions(self):
+        # (name, reader, region of canvas), see layout()
+        readers = dict(swf=self._swf_reader, grf=self._grf_reader, chat=self._chat_reader)
+        return list(map(lambda x: (x, readers[x], self._region(*self._boxes[x])), ('swf', 'grf', 'chat')))
+
+    @staticmethod
+    def _region(x, y, w, h):
+        return np.s_[y:y + h, x:x + w]
+
+    def _canvas_shape(self):
+        w, h = self._output_size
+        return h, w, 3
+
+    def _check_regions(self):
+        # a frame which does not fit the canvas would be read in part and misalign all later frames
+        canvas = np.empty(self._canvas_shape()[:2], dtype='uint8')
+        for name, reader, region in self._regions():
+            w, h = reader.size
+            if canvas[region].shape != (h, w):
+                raise ValueError('%s frame of %dx%d does not fit the output of %dx%d'
+                                 % (name, w, h, canvas.shape[1], canvas.shape[0]))
+
+    def _init_canvas(self):
+        """
+        one output canvas for all frames,
+        each input has a reusable frame buffer and a view of the canvas to be copied to.
+        """
+        self._check_regions()
+        self._canvas = np.zeros(self._canvas_shape(), dtype='uint8')
+        self._inputs = []
+        for _, reader, region in self._regions():
+            w, h = reader.size
+            self._inputs.append((reader, np.empty((h, w, 3), dtype='uint8'), self._canvas[region]))
+
+    def _compose_frame(self):
+        for reader, buffer, view in self._inputs:
+            # exhausted input keeps its last frame on canvas, like read_frame()
+            if read_frame_into(reader, buffer):
+                np.copyto(view, buffer)
+        return self._canvas
+
+    def _write_canvas(self):
+        self._writer.proc.stdin.write(memoryview(self._canvas).cast('B'))
+
+    def _queue_depth(self):
+        # frames in flight for one step: one of each input and one output
+        frame_bytes = sum(map(lambda x: x[1].size[0] * x[1].size[1] * 3, self._regions()))
+        frame_bytes += int(np.prod(self._canvas_shape()))
+        return max(1, min(self._queue_size, self._max_memory // frame_bytes))
+
+    @property
+    def stalls(self):
+        # name -> (producer stalls, consumer stalls), see FramePipe
+        return {name: (pipe.producer_stalls, pipe.consumer_stalls) for name, pipe in self._pipes.items()}
 
     def merge(self):
         # get durations
@@ -63,28 +258,105 @@ class FinalMerger(object):
         max_frames = int(max_duration * self._fps)
 
         with click.progressbar(length=max_frames, label='Processing...') as bar:
-            index = 0
-            while index < max_frames:
-                sf = self.read_swf_frame()
-                gf = self.read_grf_frame()
-                cf = self.read_chat_frame()
-                frame = self._merge_frame(sf, gf, cf)
-                self.write_frame(frame)
-                index += 1
-                bar.update(1)
+            if self._queue_size > 0:
+                self._merge_threaded(max_frames, bar)
+            else:
+                self._merge_sync(max_frames, bar)
 
-    def read_swf_frame(self):
-        return self._swf_reader.read_frame()
+    def _merge_sync(self, max_frames, bar):
+        self._init_canvas()
 
-    def read_grf_frame(self):
-        return self._grf_reader.read_frame()
+        index = 0
+        while index < max_frames:
+            self._compose_frame()
+            self._write_canvas()
+            index += 1
+            bar.update(1)
 
-    def read_chat_frame(self):
-        return self._chat_reader.read_frame()
+    def _merge_threaded(self, max_frames, bar):
+        # every input is decoded on its own thread, and encoded on another one
+        self._check_regions()
+        depth = self._queue_depth()
+        regions = self._regions()
+        prefetchers = []
+        for name, reader, region in regions:
+            w, h = reader.size
+            # one more buffer, the last frame is held by the compositor
+            self._pipes[name] = FramePipe((h, w, 3), depth + 1)
+            prefetchers.append(PrefetchReader(reader, self._pipes[name], max_frames))
+        write_pipe = FramePipe(self._canvas_shape(), depth)
+        self._pipes['writer'] = write_pipe
+        writer = AsyncWriter(self._writer, write_pipe)
+        for one in prefetchers + [writer]:
+            one.start()
 
-    def write_frame(self, frame):
-        self._writer.write_frame(frame)
+        # last frame of every input, exhausted input keeps it
+        last = [None] * len(regions)
+        done = [False] * len(regions)
+        for _ in range(max_frames):
+            canvas = write_pipe.acquire()
+            for i, (name, _, region) in enumerate(regions):
+                pipe = self._pipes[name]
+                if not done[i]:
+                    buffer = pipe.get()
+                    if buffer is None:
+                        done[i] = True
+                    else:
+                        if last[i] is not None:
+                            pipe.release(last[i])
+                        last[i] = buffer
+                if last[i] is not None:
+                    np.copyto(canvas[region], last[i])
+            write_pipe.publish(canvas)
+            bar.update(1)
+
+        write_pipe.publish(None)
+        for one in prefetchers + [writer]:
+            one.join()
+        # a failed input must not look like one which ended and keeps its last frame
+        for one in prefetchers + [writer]:
+            if one.error:
+                raise one.error
 
     def close(self):
         for one in (self._swf_reader, self._grf_reader, self._chat_reader, self._writer):
             one.close()
+
+
+class FilterComplexMerger(BaseMerger):
+    """
+    compose frames with one ffmpeg filter_complex graph in a single process,
+    audio is copied from grf mp4.
+    ended inputs keep their last frame until the longest one ends, like FinalMerger.
+    """
+
+    def __init__(self, swf_mp4, grf_mp4, chat_mp4, output, fps=10, loglevel=FFMPEG_LOGLEVEL):
+        super(FilterComplexMerger, self).__init__(swf_mp4, grf_mp4, chat_mp4, output, fps=fps)
+        self._loglevel = loglevel
+
+    def close(self):
+        pass
+
+    def filter_complex(self) -> str:
+        (width, height), boxes = self.layout()
+        sw = boxes['swf'][2]
+        gw = boxes['grf'][2]
+        ch = boxes['chat'][3]
+        # pad both columns to the same height, see layout()
+        filters = [
+            '[0:v]fps={fps},setsar=1,pad={sw}:{h}[swf]',
+            '[1:v]fps={fps},setsar=1[grf]',
+            '[2:v]fps={fps},scale={gw}:{ch},setsar=1[chat]',
+            '[grf][chat]vstack=inputs=2,pad={rw}:{h}[right]',
+            '[swf][right]hstack=inputs=2[v]',
+        ]
+        return ';'.join(filters).format(fps=self._fps, sw=sw, h=height, gw=gw, ch=ch, rw=width - sw)
+
+    def merge(self):
+        parameters = [FFMPEG_FILE, '-i', self._swf_mp4, '-i', self._grf_mp4, '-i', self._chat_mp4,
+                      '-filter_complex', self.filter_complex(),
+                      '-map', '[v]', '-map', '1:a?', '-c:v', 'libx264', '-pix_fmt', 'yuv420p',
+                      '-c:a', 'copy', '-r', str(self._fps), '-max_muxing_queue_size', '9999',
+                      '-loglevel', self._loglevel, '-stats', '-y', self._output]
+
+        subprocess.call(parameters)
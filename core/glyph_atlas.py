@@ -0,0 +1,92 @@
+import numpy as np
+from PIL import Image, ImageColor, ImageDraw
+
+
+class Glyph(object):
+    """
+    one character rasterized once,
+    mask is the alpha of the character drawn at (0, 0), advance is the pen movement after it.
+    """
+
+    def __init__(self, mask, advance):
+        self.mask = mask
+        self.alpha = np.asarray(mask)
+        self.advance = advance
+
+    @property
+    def width(self):
+        return self.alpha.shape[1]
+
+    @property
+    def height(self):
+        return self.alpha.shape[0]
+
+
+class GlyphAtlas(object):
+    """
+    glyphs keyed by (font, size, character),
+    strings are composed by alpha blitting cached masks instead of rasterizing them again.
+    """
+
+    def __init__(self):
+        self._glyphs = {}
+
+    @staticmethod
+    def _font_key(font):
+        return getattr(font, 'path', id(font)), getattr(font, 'index', 0), font.size
+
+    @staticmethod
+    def _advance(font, c):
+        if hasattr(font, 'getlength'):
+            return int(round(font.getlength(c)))
+        # pillow < 8, the width of a pair minus the width of one character
+        return font.getsize(c * 2)[0] - font.getsize(c)[0]
+
+    def get_glyph(self, font, c) -> Glyph:
+        key = self._font_key(font) + (c,)
+        glyph = self._glyphs.get(key)
+        if glyph is None:
+            width, height = font.getsize(c)
+            mask = Image.new('L', (max(width, 1), max(height, 1)), 0)
+            ImageDraw.Draw(mask).text((0, 0), c, font=font, fill=255)
+            glyph = Glyph(mask, self._advance(font, c))
+            self._glyphs[key] = glyph
+        return glyph
+
+    def getsize(self, font, text):
+        # (width, height), like font.getsize()
+        glyphs = list(map(lambda c: self.get_glyph(font, c), text))
+        if not glyphs:
+            return 0, 0
+        width = sum(map(lambda g: g.advance, glyphs[:-1])) + glyphs[-1].width
+        return width, max(map(lambda g: g.height, glyphs))
+
+    def draw_text(self, target, xy, text, font, fill):
+        """
+        :param target: RGB numpy array (height, width, 3) or PIL image, drawn in place
+        """
+        x, y = int(xy[0]), int(xy[1])
+        for c in text:
+            glyph = self.get_glyph(font, c)
+            if isinstance(target, np.ndarray):
+                self._blend(target, x, y, glyph.alpha, fill)
+            else:
+                target.paste(fill, (x, y), glyph.mask)
+            x += glyph.advance
+
+    @staticmethod
+    def _blend(target, x, y, alpha, fill):
+        h, w = target.shape[:2]
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + alpha.shape[1], w), min(y + alpha.shape[0], h)
+        if x0 >= x1 or y0 >= y1:
+            return
+        a = alpha[y0 - y:y1 - y, x0 - x:x1 - x, np.newaxis].astype(np.uint16)
+        if not a.any():
+            return
+        color = np.array(ImageColor.getrgb(fill) if isinstance(fill, str) else fill, dtype=np.uint16)
+        region = target[y0:y1, x0:x1]
+        region[...] = (region * (255 - a) + color * a + 127) // 255
+
+
+glyph_atlas = GlyphAtlas()
@@ -1,6 +1,11 @@
+import atexit
 import datetime
+import json
 import os
 import subprocess
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import ffmpeg
 from PIL import Image
@@ -18,6 +23,8 @@ add_to_system_path(FFMPEG_FILE)
 
 FFMPEG_LOGLEVEL = 'warning'
 
+PROBE_CACHE_FILE = os.path.join(os.path.expanduser('~'), '.3to1', 'ffprobe.json')
+
 
 def create_image(width, height, color=(0, 0, 0)):
     img = Image.new('RGB', (int(width), int(height)), color)
@@ -39,22 +46,137 @@ class GrfReader(object):
         return self._movie
 
 
+class ProbeCache(object):
+    """
+    ffprobe results keyed by (path, size, mtime),
+    kept in memory with lru eviction and persisted to a json file,
+    which is written by save() after a batch of probes and once at exit.
+    """
+
+    def __init__(self, filename=PROBE_CACHE_FILE, maxsize=4096):
+        self._filename = filename
+        self._maxsize = maxsize
+        self._items = OrderedDict()
+        self._loaded = False
+        self._dirty = False
+        self._lock = threading.Lock()
+        atexit.register(self.save)
+
+    @staticmethod
+    def key(path):
+        # None if path can not be stat'ed, it is not cached and ffprobe reports the error
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return '%s|%d|%d' % (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+
+    def get(self, path):
+        key = self.key(path)
+        if key is None:
+            return None
+        with self._lock:
+            self._load()
+            info = self._items.get(key)
+            if info is not None:
+                self._items.move_to_end(key)
+            return info
+
+    def put(self, path, info):
+        key = self.key(path)
+        if key is None:
+            return
+        with self._lock:
+            self._load()
+            self._items[key] = info
+            self._items.move_to_end(key)
+            while len(self._items) > self._maxsize:
+                self._items.popitem(last=False)
+            self._dirty = True
+
+    def _load(self):
+        if self._loaded or not self._filename:
+            return
+        self._loaded = True
+        try:
+            with open(self._filename, 'r') as f:
+                self._items.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+
+    def save(self):
+        if not self._filename:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            data = json.dumps(self._items)
+            self._dirty = False
+        tmp_file = '%s.%d.tmp' % (self._filename, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(self._filename), exist_ok=True)
+            with open(tmp_file, 'w') as f:
+                f.write(data)
+            os.replace(tmp_file, self._filename)
+        except OSError:
+            # cache is optional
+            pass
+
+
+probe_cache = ProbeCache()
+
+
 class FfmpegQuerier(object):
-    def __init__(self):
+    def __init__(self, cache=probe_cache):
         self._info = {}
+        self._cache = cache
 
     @property
     def info(self):
-        return self.info
+        return self._info
 
     def __call__(self, input):
         if not input:
             return
 
-        self._info = ffmpeg.probe(input, cmd=FFPROBE_FILE)
+        self._info = self.probe(input)
 
         return self
 
+    def probe(self, input):
+        info = self._cache.get(input) if self._cache else None
+        if info is None:
+            info = ffmpeg.probe(input, cmd=FFPROBE_FILE)
+            if self._cache:
+                self._cache.put(input, info)
+        return info
+
+    def probe_all(self, inputs, workers=8) -> dict:
+        # probe many files concurrently, input -> info
+        inputs = list(inputs)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            infos = list(executor.map(self.probe, inputs))
+        if self._cache:
+            self._cache.save()
+        return dict(zip(inputs, infos))
+
+    @staticmethod
+    def keyframes(input) -> list:
+        # timestamps of key frames of the first video stream, packets only, nothing is decoded
+        info = ffmpeg.probe(input, cmd=FFPROBE_FILE, select_streams='v:0', show_packets=None,
+                            show_entries='packet=pts_time,flags')
+        packets = filter(lambda x: 'K' in x.get('flags', '') and x.get('pts_time', 'N/A') != 'N/A',
+                         info.get('packets', []))
+        return sorted(map(lambda x: float(x['pts_time']), packets))
+
+    @staticmethod
+    def count_frames(input) -> int:
+        # packets of the first video stream, which is one per frame, nothing is decoded
+        info = ffmpeg.probe(input, cmd=FFPROBE_FILE, select_streams='v:0', count_packets=None,
+                            show_entries='stream=nb_read_packets')
+        streams = info.get('streams', [])
+        return int(streams[0].get('nb_read_packets', 0)) if streams else 0
+
     @property
     def only_audio(self):
         codec_types = list(map(lambda x: x['codec_type'], self._info['streams']))
@@ -67,6 +189,16 @@ class FfmpegQuerier(object):
     def duration(self):
         return self._info['format']['duration']
 
+    @property
+    def start_time(self):
+        return float(self._info['format'].get('start_time', 0))
+
+    @property
+    def video_stream(self):
+        vs = list(filter(lambda x: x['codec_type'] == 'video', self._info['streams']))
+        if vs:
+            return vs[0]
+
     @property
     def width(self):
         vs = list(filter(lambda x: x['codec_type'] == 'video', self._info['streams']))
@@ -93,6 +225,10 @@ class GrfTransformer(object):
         self._tmp_img_file = 'bg.png'
         self._default_bg_color = (0, 0, 0)
 
+    def probe_all(self, inputs):
+        # warm up probe cache before converting many files
+        return self._gq.probe_all(inputs)
+
     def _create_bg(self, width, height):
         if not os.path.exists(self._tmp_img_file):
             img = create_image(width, height, self._default_bg_color)
@@ -145,8 +281,10 @@ class GrfTransformer(object):
 
 
 class MP4Merger(object):
-    def __init__(self, loglevel=FFMPEG_LOGLEVEL):
+    def __init__(self, loglevel=FFMPEG_LOGLEVEL, stream_copy=False):
         self._log_level = loglevel
+        # join segments of the same encoding as they are
+        self._stream_copy = stream_copy
         # generate temp filename
         self.tmp_file = '%s.tmp' % get_time()
         self.reserve_tmp_file = True
@@ -174,6 +312,11 @@ class MP4Merger(object):
         # subprocess.call([FFMPEG_FILE, '-f', 'concat', '-safe', '0', '-i', self.tmp_file, '-c', 'copy',
         #                  '-r', '10', '-strict', '-2', '-loglevel', self._log_level, '-y', output])
 
+        if self._stream_copy:
+            parameters = [FFMPEG_FILE, '-f', 'concat', '-safe', '0', '-i', self.tmp_file, '-c', 'copy',
+                          '-loglevel', self._log_level, '-y', output]
+            subprocess.call(parameters)
+            return
         # force fps = 10
         parameters = [FFMPEG_FILE, '-f', 'concat', '-safe', '0', '-i', self.tmp_file, '-c:v', 'libx264',
                       '-framerate', '10', '-vf', 'fps=10', '-strict', '-2', '-pix_fmt', 'yuv420p',
@@ -183,8 +326,7 @@ class MP4Merger(object):
     def merge_using_record_xml_of_grf(self, record_xml, folder, output):
         from core.xml_reader import RecordXml
         rx = RecordXml()
-        rx.read(record_xml)
-        rx.parse()
+        rx.load(record_xml)
         grfs = rx.grfs
         # change *.grf to *.mp4
         mp4s = list(map(lambda x: x.get('multimedia').replace('grf', 'mp4'), grfs))
@@ -194,8 +336,7 @@ class MP4Merger(object):
     def merge_using_record_xml_of_swf(self, record_xml, folder, output):
         from core.xml_reader import RecordXml
         rx = RecordXml()
-        rx.read(record_xml)
-        rx.parse()
+        rx.load(record_xml)
         swfs = rx.swfs
         # change *.grf to *.mp4
         # use unique filename
@@ -1,25 +1,39 @@
 import os
-import re
+import shutil
+import tempfile
 import textwrap
 import subprocess
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import click
+import numpy as np
 from PIL import Image, ImageDraw
 from moviepy.video.io.ffmpeg_reader import FFMPEG_VideoReader
 from moviepy.video.io.ffmpeg_writer import FFMPEG_VideoWriter
 
 from core.chat_editor import default_font
+from core.glyph_atlas import glyph_atlas
 from core.grf_reader import FfmpegQuerier
 from core.grf_reader import FFMPEG_FILE
 from core.grf_reader import FFMPEG_LOGLEVEL
+from core.grf_reader import MP4Merger
 from core.xml_reader import AnnoCommand
 from core.xml_reader import AnnoXml
 from utils.timestamp import timestamp2frame
-from utils.timestamp import get_time
+
+# h264 profiles as named by ffprobe -> as named by libx264, for segments joined with copied gops
+X264_PROFILES = {
+    'Constrained Baseline': 'baseline',
+    'Baseline': 'baseline',
+    'Main': 'main',
+    'High': 'high',
+}
 
 
 class MovieEditor(object):
     def __init__(self, input, output, width=None, height=None, log_level=FFMPEG_LOGLEVEL):
+        self._input = input
         self._reader = FFMPEG_VideoReader(input)
         self._fps = self._reader.fps
         # self.cur_frame = 1
@@ -31,95 +45,286 @@ class MovieEditor(object):
         self._resize = (int(width), int(height)) if (width and height) else None
         self._loglevel = log_level
         self._output = output
-        self._tmp_file = self._make_tmp_file(input) if self._resize else None
-        self._writer = FFMPEG_VideoWriter(
-            self._tmp_file if self.need_resize else output,
-            size=self._reader.size,
-            fps=self._reader.fps)
+        # opened on first write, segment mode writes no frame to it
+        self._writer = None
+        # frame indexes of key frames, probed on first seek
+        self._keyframes = None
+        # frame index of key frame -> its time from the start of input
+        self._keyframe_times = {}
+
+    @property
+    def writer(self):
+        if self._writer is None:
+            self._writer = self.make_writer(self._output)
+        return self._writer
+
+    def make_writer(self, filename):
+        # frames are drawn at input size, and scaled by the encoder in the same pass
+        params = ['-vf', 'scale=%d:%d' % self._resize] if self.need_resize else self.copy_params
+        return FFMPEG_VideoWriter(filename, size=self._reader.size, fps=self._reader.fps, ffmpeg_params=params)
 
     @property
     def need_resize(self):
         return self._resize and list(self._resize) != list(self._reader.size)
 
-    # for resizing
-    def _make_tmp_file(self, input):
-        return '%s-%s.mp4' % (input, get_time())
-
-    def _remove_tmp_file(self):
-        if os.path.exists(self._tmp_file):
-            os.remove(self._tmp_file)
+    @property
+    def copy_params(self):
+        """
+        encoder parameters for frames to be joined with gops copied from input, None if input can not be copied.
+        the writer always encodes yuv420p, so only h264 yuv420p of a profile libx264 has is copied.
+        """
+        stream = self._querier.video_stream
+        if self.need_resize or not stream or stream.get('codec_name') != 'h264' \
+                or stream.get('pix_fmt') != 'yuv420p' or stream.get('profile') not in X264_PROFILES:
+            return None
+        params = ['-profile:v', X264_PROFILES[stream['profile']]]
+        level = int(stream.get('level', 0))
+        if level > 0:
+            params += ['-level', '%.1f' % (level / 10.0)]
+        return params
 
     # approximate frame count
     def get_total_frame(self):
         return timestamp2frame(self._duration, self._fps)
 
-    # def seek_frame(self, index):
-    #     self._reader.skip_frames(index - self.cur_frame)
-    #     self._frame = self._reader.read_frame()
-    #
-    # def seek_timestamp(self, timestamp):
-    #     index = FrameEditor.which_frame(timestamp, self._fps)
-    #     self.seek_frame(index)
-    #
-    # def draw_anno(self, anno):
-    #     if self._frame is not None:
-    #         self._frame_editor.frame = self._frame
-    #         self._frame_editor.draw_anno(anno)
-
-    def draw_anno_file(self, anno_filename):
-        # parse anno file
-        ax = AnnoXml()
-        ax.read(anno_filename)
-        ax.parse()
-        commands = ax.command
+    @property
+    def keyframes(self):
+        if self._keyframes is None:
+            start_time = self._querier.start_time
+            times = {}
+            for pts_time in self._querier.keyframes(self._input):
+                times.setdefault(int(round((pts_time - start_time) * self._fps)), pts_time - start_time)
+            self._keyframe_times = times
+            self._keyframes = sorted(times)
+        return self._keyframes
+
+    def seek_frame(self, index):
+        # decode from the key frame at or before index, the next read_frame() returns frame index
+        i = bisect_right(self.keyframes, index)
+        keyframe = self.keyframes[i - 1] if i > 0 else 0
+        self._reader.initialize(keyframe / float(self._fps))
+        self._reader.pos = keyframe
+        self._reader.skip_frames(index - keyframe)
+
+    def seek_timestamp(self, timestamp):
+        self.seek_frame(FrameEditor.which_frame(timestamp, self._fps))
+
+    def render_range(self, anno_index, start, stop, writer, bar=None):
+        """
+        draw frames [start, stop) of input using anno_index and write them to writer,
+        frame n of output is frame n of input, as in draw_anno_segments().
+        """
+        self.seek_frame(start)
+        frame_editors = {}
+        for frame_index in range(start, stop):
+            frame = self._reader.read_frame()
+            pageid, objs = anno_index.at_frame(frame_index)
+            if objs:
+                # the overlay is kept until the visible strokes change
+                frame_editor = frame_editors.get(pageid)
+                if frame_editor is None:
+                    frame_editor = frame_editors[pageid] = FrameEditor(fps=self._fps, pageid=pageid)
+                frame_editor.set_commands(objs)
+                frame_editor.draw(frame)
+                frame = frame_editor.array
+            writer.write_frame(frame)
+            if bar:
+                bar.update(1)
 
+    def frame_plan(self, commands, total_frame):
+        """
+        yield (start, stop, frame_editor) runs of frames in order,
+        frames in [start, stop) are drawn with frame_editor, or left as they are if it is None.
+        frame_editor is only valid until the next run is requested, since commands keep being appended.
+        """
         fps = self._fps
-        frame = self._reader.read_frame()
-        self._writer.write_frame(frame)
+        # first frame
+        yield 0, 1, None
+        frame_index = 1
+        for command in commands:
+            pageid = command.pageid
+            command_frame = CommandParser.get_frame_index(command, fps)
+            if pageid in self.draw_dict:
+                frame_editor = self.draw_dict[pageid]
+            else:
+                frame_editor = FrameEditor(fps=fps, pageid=pageid)
+                self.draw_dict[pageid] = frame_editor
+            # before
+            if frame_index < command_frame:
+                yield frame_index, command_frame, frame_editor if frame_editor.commands else None
+                frame_index = command_frame
+            # append
+            frame_editor.append_command(command)
+            # current
+            yield frame_index, frame_index + 1, frame_editor if frame_editor.commands else None
+            frame_index += 1
+        # left frames
+        if frame_index < total_frame:
+            yield frame_index, total_frame, None
+
+    def draw_anno_file(self, anno_filename, stream_copy=False, workers=1):
+        # parse anno file, commands are streamed
+        ax = AnnoXml()
+        commands = ax.iter_command(anno_filename, self._fps)
+
+        # copied segments can not be resized, nor joined with frames of another encoding
+        stream_copy = stream_copy and self.copy_params is not None
+        if stream_copy or workers > 1:
+            self.draw_anno_segments(list(commands), stream_copy, workers)
+            return
+
         # total frame
         total_frame = self.get_total_frame()
         with click.progressbar(length=total_frame, label='Processing...') as bar:
-            # current
-            frame_index = 1
-            bar.update(1)
-            for command in commands:
-                pageid = command.pageid
-                command_frame = CommandParser.get_frame_index(command, fps)
-                if pageid in self.draw_dict:
-                    frame_editor = self.draw_dict[pageid]
-                else:
-                    frame_editor = FrameEditor(fps=fps, pageid=pageid)
-                    self.draw_dict[pageid] = frame_editor
-                # before
-                while frame_index < command_frame:
-                    if not frame_editor.commands:
-                        frame = self.read_frame()
-                        self.write_frame(frame)
-                    else:
-                        frame = self.read_frame()
+            for start, stop, frame_editor in self.frame_plan(commands, total_frame):
+                for _ in range(start, stop):
+                    frame = self.read_frame()
+                    if frame_editor:
                         frame_editor.draw(frame)
-                        self.write_frame(frame_editor.image)
-                    frame_index += 1
+                        frame = frame_editor.array
+                    self.write_frame(frame)
                     bar.update(1)
-                # append
-                frame_editor.append_command(command)
-                # current
-                frame = self.read_frame()
-                frame_editor.draw(frame)
-                self.write_frame(frame_editor.image)
-                frame_index += 1
-                bar.update(1)
-            # write left frames
-            while frame_index < total_frame:
-                self.write_frame(self.read_frame())
-                frame_index += 1
-                bar.update(1)
         # close stream
         self.close()
-        # resize if needed
-        if self.need_resize:
-            self.resize()
-            self._remove_tmp_file()
+
+    def draw_anno_segments(self, commands, stream_copy=True, workers=1):
+        """
+        split input at key frames into segments, render them in up to workers processes,
+        then join all segments with the concat demuxer.
+        with stream_copy, only the gops in which annotations are visible are re-encoded, the others are copied.
+        unlike draw_anno_file(), output frame n is exactly frame n of input.
+        """
+        total_frame = self.get_total_frame()
+        stream_copy = stream_copy and self.copy_params is not None
+        if stream_copy:
+            # dry run for annotated frames
+            annotated = [(start, stop) for start, stop, frame_editor in self.frame_plan(commands, total_frame)
+                         if frame_editor]
+            self.draw_dict = {}
+            segments = self.make_segments(annotated, self.keyframes, total_frame)
+        else:
+            segments = [(0, total_frame, True)]
+        segments = self.split_segments(segments, self.keyframes, workers)
+        anno_index = AnnoIndex(commands, self._fps)
+
+        tmp_dir = tempfile.mkdtemp(prefix='anno-')
+        filenames = list(map(lambda i: os.path.join(tmp_dir, '%06d.ts' % i), range(len(segments))))
+        try:
+            with click.progressbar(length=total_frame, label='Processing...') as bar:
+                if workers > 1:
+                    with ProcessPoolExecutor(max_workers=workers) as executor:
+                        futures = {}
+                        for (start, stop, encode), filename in zip(segments, filenames):
+                            if encode:
+                                future = executor.submit(render_shard, self._input, self._resize, anno_index,
+                                                         self.keyframes, start, stop, filename)
+                                futures[future] = stop - start
+                        # copy while shards are being rendered
+                        for (start, stop, encode), filename in zip(segments, filenames):
+                            if not encode:
+                                self._copy_or_encode(anno_index, start, stop, filename, bar)
+                        for future in as_completed(futures):
+                            future.result()
+                            bar.update(futures[future])
+                else:
+                    for (start, stop, encode), filename in zip(segments, filenames):
+                        if encode:
+                            self._encode_segment(anno_index, start, stop, filename, bar)
+                        else:
+                            self._copy_or_encode(anno_index, start, stop, filename, bar)
+            self._reader.close()
+            merger = MP4Merger(loglevel=self._loglevel, stream_copy=True)
+            merger.tmp_file = os.path.join(tmp_dir, 'segments.txt')
+            merger.merge(filenames, tmp_dir, self._output)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        frame_count = self._querier.count_frames(self._output)
+        if frame_count != total_frame:
+            click.echo('%s has %d frames, %d expected' % (self._output, frame_count, total_frame), err=True)
+            if stream_copy:
+                # copied gops did not join, encode everything
+                self.draw_anno_segments(commands, False, workers)
+
+    @staticmethod
+    def split_segments(segments, keyframes, count):
+        """
+        cut encoded segments at key frames into about count shards of similar length,
+        copied segments are left as they are.
+        """
+        encoded = sum(map(lambda x: x[1] - x[0], filter(lambda x: x[2], segments)))
+        if count <= 1 or not encoded:
+            return segments
+        size = max(encoded // count, 1)
+        result = []
+        for start, stop, encode in segments:
+            if not encode:
+                result.append((start, stop, encode))
+                continue
+            # key frames inside the segment
+            cuts = keyframes[bisect_right(keyframes, start):bisect_left(keyframes, stop)]
+            for cut in cuts:
+                if cut - start >= size:
+                    result.append((start, cut, True))
+                    start = cut
+            result.append((start, stop, True))
+        return result
+
+    @staticmethod
+    def make_segments(annotated, keyframes, total_frame):
+        """
+        split [0, total_frame) at key frames into (start, stop, encode) segments,
+        a segment is encoded if any annotated frame is in it.
+        """
+        keyframes = sorted(set(filter(lambda x: 0 < x < total_frame, keyframes)))
+        segments = []
+        for start, stop in annotated:
+            # extend to the key frames around
+            i = bisect_right(keyframes, start)
+            start = keyframes[i - 1] if i > 0 else 0
+            i = bisect_left(keyframes, stop)
+            stop = keyframes[i] if i < len(keyframes) else total_frame
+            if segments and segments[-1][1] >= start:
+                segments[-1][1] = max(segments[-1][1], stop)
+            else:
+                segments.append([start, stop])
+        result = []
+        cursor = 0
+        for start, stop in segments:
+            if cursor < start:
+                result.append((cursor, start, False))
+            result.append((start, stop, True))
+            cursor = stop
+        if cursor < total_frame:
+            result.append((cursor, total_frame, False))
+        return result
+
+    def _encode_segment(self, anno_index, start, stop, filename, bar=None):
+        writer = self.make_writer(filename)
+        self.render_range(anno_index, start, stop, writer, bar)
+        writer.close()
+
+    def _copy_or_encode(self, anno_index, start, stop, filename, bar):
+        # a segment which is not copied whole is encoded, it has no annotation so it is only slower
+        if self._copy_segment(start, stop, filename):
+            bar.update(stop - start)
+        else:
+            self._encode_segment(anno_index, start, stop, filename, bar)
+
+    def _copy_segment(self, start, stop, filename) -> bool:
+        """
+        copy gops of frames [start, stop) of input, start is a key frame, False if not all of them were copied.
+        input is seeked a quarter of frame after the time of the key frame, it goes back to the key frame,
+        whereas the time of the frame index may be before it and go back to the key frame before.
+        """
+        fps = float(self._fps)
+        time = self._keyframe_times.get(start, start / fps) + 0.25 / fps
+        parameters = [FFMPEG_FILE, '-ss', '%.6f' % time, '-i', self._input,
+                      '-frames:v', str(stop - start), '-an', '-c', 'copy', '-bsf:v', 'h264_mp4toannexb',
+                      '-f', 'mpegts', '-loglevel', self._loglevel, '-y', filename]
+        if subprocess.call(parameters) != 0:
+            return False
+        return self._querier.count_frames(filename) == stop - start
 
     def read_frame(self):
         return self._reader.read_frame()
@@ -130,24 +335,26 @@ class MovieEditor(object):
         #         frame = Image.fromarray(frame.astype('uint8'))
         # Here's a bug.
         #     frame = frame.resize(self._resize, Image.ANTIALIAS)
-        self._writer.write_frame(frame)
-
-    def resize(self):
-        parameters = [FFMPEG_FILE, '-i', self._tmp_file,
-                      '-s', '{w}*{h}'.format(w=self._resize[0], h=self._resize[1]),
-                      '-loglevel', self._loglevel, '-y', self._output]
-
-        subprocess.call(parameters)
+        self.writer.write_frame(frame)
 
     def close(self):
         self._reader.close()
-        self._writer.close()
+        if self._writer is not None:
+            self._writer.close()
 
 
-class CommandParser(object):
-    def __init__(self):
-        self._point_pair_pattern = re.compile('\((\d+\.?\d+?),(\d+\.?\d+?)\)')
+def render_shard(input, size, anno_index, keyframes, start, stop, output):
+    # runs in a worker process of MovieEditor.draw_anno_segments()
+    me = MovieEditor(input, output, *(size or (None, None)))
+    me._keyframes = keyframes
+    writer = me.make_writer(output)
+    me.render_range(anno_index, start, stop, writer)
+    writer.close()
+    me.close()
+    return output
+
 
+class CommandParser(object):
     def not_remove(self, commmand: AnnoCommand):
         return commmand.removed == ''
 
@@ -157,19 +364,19 @@ class CommandParser(object):
         if self.not_remove(command):
             c = command.color.split(',')[0]
             w = command.linesize
-            p = self._parse_points(command.p)
+            # points are parsed by AnnoXml already
+            p = command.points
             t = command.timestamp
             return DrawObject(_id, c, w, p, t, command.type, command.tail)
         else:
             r = command.removed
             return RemoveObject(_id, r)
 
-    def _parse_points(self, p):
-        li = self._point_pair_pattern.findall(p)
-        return list(map(lambda x: (int(float(x[0])), int(float(x[1]))), li))
-
     @staticmethod
     def get_frame_index(command: AnnoCommand, fps):
+        # precomputed by AnnoXml if fps was given
+        if command.frame != '':
+            return command.frame
         return timestamp2frame(command.timestamp, fps)
 
 
@@ -238,24 +445,34 @@ class DrawType(object):
 
 
 class FrameEditor(object):
+    # supported types
+    supported_types = (
+        DrawType.free_line,  # free line(multi-points)
+        DrawType.remove,  # remove
+        DrawType.text,  # text
+        DrawType.rectangle,  # rectangle
+        DrawType.line,  # line(two-points)
+    )
+
     def __init__(self, fps=None, cp=command_parser, pageid='', font=default_font):
         self._frame = None
         self._fps = fps
         self._image = None
         self._draw = None
-        self._commands = []
+        # frame blended by draw(), self._image is made of it when asked for
+        self._array = None
+        # id -> DrawObject, in drawing order
+        self._commands = {}
         # command parser
         self._cp = cp
         self._pageid = pageid
-        # supported types
-        self._supported_types = [
-            DrawType.free_line,  # free line(multi-points)
-            DrawType.remove,  # remove
-            DrawType.text,  # text
-            DrawType.rectangle,  # rectangle
-            DrawType.line,  # line(two-points)
-        ]
         self._font = font
+        # bumped whenever commands change
+        self._version = 0
+        # (pixel indexes, 255 - alpha, premultiplied color) of the rendered commands
+        self._overlay = None
+        # (version, size) of the overlay
+        self._overlay_key = None
 
     @property
     def pageid(self):
@@ -263,7 +480,7 @@ class FrameEditor(object):
 
     @property
     def commands(self):
-        return self._commands
+        return self._commands.values()
 
     @property
     def frame(self):
@@ -272,6 +489,7 @@ class FrameEditor(object):
     @frame.setter
     def frame(self, f):
         self._frame = f
+        self._array = None
         self._image = Image.fromarray(f.astype('uint8'))
         self._draw = ImageDraw.Draw(self._image)
 
@@ -287,8 +505,8 @@ class FrameEditor(object):
         x = p1[0]
         y_text = p1[1]
         for line in lines:
-            width, height = self._font.getsize(line)
-            self._draw.text((x, y_text), line, font=self._font, fill=color or (0, 0, 0))
+            width, height = glyph_atlas.getsize(self._font, line)
+            glyph_atlas.draw_text(self._image, (x, y_text), line, self._font, color or (0, 0, 0))
             y_text += height
 
     def _draw_points(self, points, width, color):
@@ -304,6 +522,14 @@ class FrameEditor(object):
             return
         return list(map(lambda x: x.id, self.commands))
 
+    def set_commands(self, objs):
+        # replace all commands with DrawObjects in drawing order
+        ids = tuple(map(lambda x: x.id, objs))
+        if ids == tuple(self._commands):
+            return
+        self._commands = dict(zip(ids, objs))
+        self._version += 1
+
     def append_command(self, command: AnnoCommand):
         # type '2' --> free line
         # type '3' --> remove
@@ -312,28 +538,59 @@ class FrameEditor(object):
         # type '8' --> line
         # type '9' --> unknown
 
-        if command.type not in self._supported_types:
+        if command.type not in self.supported_types:
             return
 
         c = self._cp(command)
         if isinstance(c, RemoveObject):
-            _id = c.remove_id
-            self._commands = list(filter(lambda x: x.id != _id, self.commands))
+            self._commands.pop(c.remove_id, None)
         else:
-            self._commands.append(c)
+            # a reused id is drawn on top
+            self._commands.pop(c.id, None)
+            self._commands[c.id] = c
+        self._version += 1
 
     def draw_command(self, obj: DrawObject, frame):
         self.frame = frame
-        ps = obj.points
+        ps = list(map(tuple, obj.points.tolist()))
         color = obj.color
         width = obj.width
         self._draw_points(ps, width, color)
 
     def draw(self, frame):
-        self.frame = frame
+        # commands are rendered once into an overlay, which is blended into every frame until they change
+        size = frame.shape[1], frame.shape[0]
+        if self._overlay_key != (self._version, size):
+            self._render_overlay(size)
+        array = np.array(frame, dtype='uint8')
+        pixels = array.reshape(-1, 3)
+        index, inverse_alpha, color = self._overlay
+        pixels[index] = (pixels[index] * inverse_alpha + 127) // 255 + color
+        self._frame = frame
+        self._array = array
+        self._image = None
+        self._draw = None
+
+    def _render_overlay(self, size):
+        # colors are drawn on black, so they are premultiplied by the coverage drawn on the alpha layer
+        layers = []
+        for mode, fill in (('RGB', None), ('L', 255)):
+            self._image = Image.new(mode, size, 0)
+            self._draw = ImageDraw.Draw(self._image)
+            self._draw_commands(fill)
+            layers.append(np.asarray(self._image))
+        color, alpha = layers[0].reshape(-1, 3), layers[1].reshape(-1)
+        index = np.flatnonzero(alpha)
+        self._overlay = (index,
+                         255 - alpha[index, np.newaxis].astype(np.uint16),
+                         color[index].astype(np.uint16))
+        self._overlay_key = (self._version, size)
+
+    def _draw_commands(self, fill=None):
+        # fill overrides colors of all commands
         for obj in self.commands:
-            ps = obj.points
-            color = obj.color
+            ps = list(map(tuple, obj.points.tolist()))
+            color = obj.color if fill is None else fill
             width = obj.width
             type = obj.type
             tail = obj.tail
@@ -350,4 +607,78 @@ class FrameEditor(object):
 
     @property
     def image(self):
+        # PIL image of the drawn frame
+        if self._image is None and self._array is not None:
+            self._image = Image.fromarray(self._array)
         return self._image
+
+    @property
+    def array(self):
+        # uint8 array of the drawn frame, draw() makes it without going through PIL
+        if self._array is None and self._image is not None:
+            self._array = np.asarray(self._image)
+        return self._array
+
+
+class AnnoIndex(object):
+    """
+    interval index of strokes over frames, to know which strokes are visible on which page at any frame.
+    frames follow MovieEditor.frame_plan(): commands take successive frames, each one at or after its own,
+    the page shown until a command is the page of that command, nothing is drawn after the last one.
+    """
+
+    def __init__(self, commands, fps, cp=command_parser):
+        self._fps = fps
+        self._frames = []
+        self._pageids = []
+        # pageid -> {id: [start, DrawObject]} of strokes not removed yet
+        alive = {}
+        # pageid -> [(start, stop, DrawObject)]
+        intervals = {}
+        frame_index = 1
+        for command in commands:
+            frame_index = max(frame_index, CommandParser.get_frame_index(command, fps))
+            pageid = command.pageid
+            self._frames.append(frame_index)
+            self._pageids.append(pageid)
+            if command.type in FrameEditor.supported_types:
+                strokes = alive.setdefault(pageid, {})
+                c = cp(command)
+                _id = c.remove_id if isinstance(c, RemoveObject) else c.id
+                if _id in strokes:
+                    start, obj = strokes.pop(_id)
+                    intervals.setdefault(pageid, []).append((start, frame_index, obj))
+                if not isinstance(c, RemoveObject):
+                    strokes[_id] = (frame_index, c)
+            frame_index += 1
+        for pageid, strokes in alive.items():
+            for start, obj in strokes.values():
+                intervals.setdefault(pageid, []).append((start, float('inf'), obj))
+        # sorted by start, which is also the drawing order
+        self._pages = {}
+        for pageid, items in intervals.items():
+            items.sort(key=lambda x: x[0])
+            self._pages[pageid] = (np.array(list(map(lambda x: x[0], items)), dtype=np.float64),
+                                   np.array(list(map(lambda x: x[1], items)), dtype=np.float64),
+                                   list(map(lambda x: x[2], items)))
+
+    def page_at(self, frame_index):
+        i = bisect_left(self._frames, frame_index)
+        if frame_index < 1 or i == len(self._frames):
+            return None
+        return self._pageids[i]
+
+    def visible(self, pageid, frame_index):
+        # DrawObjects of pageid visible at frame_index, in drawing order
+        if pageid not in self._pages:
+            return []
+        starts, stops, objs = self._pages[pageid]
+        n = starts.searchsorted(frame_index, side='right')
+        return list(map(lambda i: objs[i], np.flatnonzero(stops[:n] > frame_index)))
+
+    def at_frame(self, frame_index):
+        pageid = self.page_at(frame_index)
+        return pageid, self.visible(pageid, frame_index) if pageid is not None else []
+
+    def at(self, timestamp):
+        return self.at_frame(FrameEditor.which_frame(timestamp, self._fps))
@@ -0,0 +1,338 @@
+import io
+
+import numpy as np
+from PIL import Image, ImageDraw
+from swf.consts import LineCapsStyle, LineScaleMode
+from swf.export import DefaultShapeExporter
+
+# swf coordinates are in twips
+TWIPS_PER_PIXEL = 20.0
+
+
+class UnsupportedContent(Exception):
+    pass
+
+
+class Fill(object):
+    """
+    one fill of a shape, paths are closed lists of segments in pixels of the shape,
+    a segment is (x, y) or (cx, cy, x, y) for a quadratic curve.
+    """
+
+    def __init__(self, color=None, alpha=1.0, bitmap_id=None, matrix=None, smooth=True):
+        self.color = color
+        self.alpha = alpha
+        self.bitmap_id = bitmap_id
+        self.matrix = matrix
+        self.smooth = smooth
+        self.paths = []
+
+
+class Stroke(object):
+    """
+    one line style of a shape, paths are open lists of segments like those of Fill.
+    """
+
+    def __init__(self, width, color=0, alpha=1.0, scaled=True, round_caps=True):
+        self.width = width
+        self.color = color
+        self.alpha = alpha
+        self.scaled = scaled
+        self.round_caps = round_caps
+        self.paths = []
+
+
+class ShapeCollector(DefaultShapeExporter):
+    """
+    collects fills and strokes of a shape exported by pyswf, in drawing order,
+    pyswf has joined the edges of every fill style into closed paths.
+    unsupported styles are only recorded in `unsupported`, pyswf catches any error of begin_*_fill
+    and begins a black fill instead.
+    """
+
+    def __init__(self):
+        super(ShapeCollector, self).__init__()
+        self.styles = []
+        self.unsupported = None
+        self._style = None
+
+    def _unsupported(self, reason, style):
+        self.unsupported = self.unsupported or reason
+        # paths of the style are collected and never drawn
+        self._begin(style)
+
+    def begin_fills(self):
+        self._style = None
+
+    def begin_lines(self):
+        self._style = None
+
+    def _begin(self, style):
+        self._style = style
+        self.styles.append(style)
+
+    def begin_fill(self, color, alpha=1.0):
+        self._begin(Fill(color=color, alpha=alpha))
+
+    def begin_bitmap_fill(self, bitmap_id, matrix=None, repeat=False, smooth=False):
+        self._begin(Fill(bitmap_id=bitmap_id, matrix=matrix, smooth=smooth))
+
+    def begin_gradient_fill(self, *args, **kwargs):
+        self._unsupported('gradient fill', Fill(color=0))
+
+    def line_style(self, thickness=float('nan'), color=0, alpha=1.0, pixelHinting=False,
+                   scaleMode=LineScaleMode.NORMAL, startCaps=None, endCaps=None, joints=None, miterLimit=3.0):
+        # thickness is in pixels, nan or 0 for hairlines
+        self._begin(Stroke(thickness if thickness > 0 else 0, color, alpha,
+                           scaled=scaleMode == LineScaleMode.NORMAL,
+                           round_caps=startCaps in (None, LineCapsStyle.ROUND)))
+
+    def line_gradient_style(self, *args, **kwargs):
+        self._unsupported('gradient line', Stroke(0))
+
+    def line_bitmap_style(self, *args, **kwargs):
+        self._unsupported('bitmap line', Stroke(0))
+
+    def move_to(self, x, y):
+        if self._style is None:
+            raise UnsupportedContent('path without style')
+        self._style.paths.append([(x, y)])
+
+    def line_to(self, x, y):
+        if self._style is None or not self._style.paths:
+            raise UnsupportedContent('path without style')
+        self._style.paths[-1].append((x, y))
+
+    def curve_to(self, cx, cy, ax, ay):
+        if self._style is None or not self._style.paths:
+            raise UnsupportedContent('path without style')
+        self._style.paths[-1].append((cx, cy, ax, ay))
+
+
+def flatten(path, transform, tolerance=0.1):
+    """
+    points of a path in output pixels, curves are transformed first and then split into lines,
+    so they are as smooth at any scale.
+    """
+    points = []
+    for segment in path:
+        xy = transform.dot(np.array([segment[-2], segment[-1], 1.0]))[:2]
+        if len(segment) == 4 and points:
+            p0 = points[-1]
+            c = transform.dot(np.array([segment[0], segment[1], 1.0]))[:2]
+            # distance of the curve from its chords is at most |p0 - 2c + p1| / (4 n^2)
+            n = int(min(max(np.ceil(np.sqrt(np.hypot(*(p0 - 2 * c + xy)) / (4 * tolerance))), 1), 64))
+            for t in np.arange(1, n) / float(n):
+                points.append((1 - t) ** 2 * p0 + 2 * (1 - t) * t * c + t ** 2 * xy)
+        points.append(xy)
+    return points
+
+
+def to_rgb(color):
+    return (color >> 16) & 0xff, (color >> 8) & 0xff, color & 0xff
+
+
+def to_affine(matrix, unit=1.0):
+    # swf matrix -> 3x3, x' = scaleX * x + rotateSkew1 * y + translateX, translation divided by unit
+    if matrix is None:
+        return np.identity(3)
+    return np.array([[matrix.scaleX, matrix.rotateSkew1, matrix.translateX / unit],
+                     [matrix.rotateSkew0, matrix.scaleY, matrix.translateY / unit],
+                     [0, 0, 1]], dtype=np.float64)
+
+
+class SwfRasterizer(object):
+    """
+    renders the first frame of swf files made of shapes without a browser,
+    solid and bitmap fills, strokes, straight and curved edges are drawn at the target size.
+    render() returns None for anything else, e.g. text, sprites, gradients or filters, which is left to chrome.
+    """
+    shape_tags = ('DefineShape', 'DefineShape2', 'DefineShape3', 'DefineShape4')
+    bitmap_tags = ('DefineBitsJPEG2', 'DefineBitsJPEG3')
+    place_tags = ('PlaceObject', 'PlaceObject2', 'PlaceObject3')
+    remove_tags = ('RemoveObject', 'RemoveObject2')
+    # edges are drawn at this many times the target size and averaged down, for anti-aliasing
+    supersample = 4
+    # tags which do not change how the first frame looks
+    ignored_tags = ('End', 'SetBackgroundColor', 'FileAttributes', 'Metadata', 'FrameLabel', 'JPEGTables',
+                    'DefineSceneAndFrameLabelData', 'TagProtect', 'TagEnableDebugger', 'TagEnableDebugger2',
+                    'TagScriptLimits', 'TagDebugID', 'TagProductInfo')
+
+    def render(self, swf, width, height):
+        try:
+            return self._render(swf, int(width), int(height))
+        except UnsupportedContent:
+            return None
+
+    def _render(self, swf, width, height):
+        characters, display_list, background = self._read_first_frame(swf)
+        rect = swf.header.frame_size
+        stage_width = (rect.xmax - rect.xmin) / TWIPS_PER_PIXEL
+        stage_height = (rect.ymax - rect.ymin) / TWIPS_PER_PIXEL
+        if stage_width <= 0 or stage_height <= 0:
+            raise UnsupportedContent('empty stage')
+        # stage pixels -> output pixels, as flash player's default showAll: the stage keeps its aspect ratio,
+        # centered in the output, margins are left to the background
+        scale = min(width / stage_width, height / stage_height)
+        dx = (width - stage_width * scale) / 2 - rect.xmin / TWIPS_PER_PIXEL * scale
+        dy = (height - stage_height * scale) / 2 - rect.ymin / TWIPS_PER_PIXEL * scale
+        stage = np.array([[scale, 0, dx],
+                          [0, scale, dy],
+                          [0, 0, 1]], dtype=np.float64)
+        canvas = Image.new('RGB', (width, height), background)
+        bitmaps = {}
+        for depth in sorted(display_list):
+            character_id, matrix = display_list[depth]
+            tag = characters.get(character_id)
+            if tag is None or tag.name not in self.shape_tags:
+                raise UnsupportedContent('character %s' % character_id)
+            transform = stage.dot(to_affine(matrix, TWIPS_PER_PIXEL))
+            for style in self._collect(tag):
+                if isinstance(style, Stroke):
+                    self._draw_stroke(canvas, style, transform, stage)
+                else:
+                    self._draw_fill(canvas, style, transform, characters, bitmaps)
+        return canvas
+
+    def _read_first_frame(self, swf):
+        # characters, depth -> (character id, matrix), background color
+        characters = {}
+        display_list = {}
+        background = (255, 255, 255)
+        for tag in swf.tags:
+            name = tag.name
+            if name == 'ShowFrame':
+                return characters, display_list, background
+            if name in self.place_tags:
+                for flag in ('hasColorTransform', 'hasClipDepth', 'hasFilterList', 'hasBlendMode', 'hasImage'):
+                    if getattr(tag, flag, False):
+                        raise UnsupportedContent(flag)
+                if tag.hasCharacter:
+                    display_list[tag.depth] = (tag.characterId, tag.matrix if tag.hasMatrix else None)
+                elif tag.depth in display_list and tag.hasMatrix:
+                    display_list[tag.depth] = (display_list[tag.depth][0], tag.matrix)
+            elif name in self.remove_tags:
+                display_list.pop(tag.depth, None)
+            elif name == 'SetBackgroundColor':
+                background = to_rgb(tag.color)
+            elif name in self.ignored_tags:
+                continue
+            elif name.replace('Tag', '', 1).startswith('Define'):
+                # definitions do not draw anything until they are placed
+                characters[tag.characterId] = tag
+            else:
+                raise UnsupportedContent(name)
+        return characters, display_list, background
+
+    @staticmethod
+    def _collect(tag):
+        # styles of a shape tag, exported once, since pyswf appends styles on every export
+        collector = getattr(tag, '_raster_collector', None)
+        if collector is None:
+            collector = ShapeCollector()
+            tag.export(collector)
+            tag._raster_collector = collector
+        if collector.unsupported:
+            raise UnsupportedContent(collector.unsupported)
+        return collector.styles
+
+    def _draw_fill(self, canvas, fill, transform, characters, bitmaps):
+        polygons = list(filter(lambda x: len(x) >= 3, map(lambda x: flatten(x, transform), fill.paths)))
+        box = self._box(canvas.size, polygons, 0)
+        if box is None:
+            return
+        mask = self._fill_mask(box, polygons)
+        if fill.bitmap_id is None:
+            self._paste(canvas, box, to_rgb(fill.color), mask, fill.alpha)
+            return
+        bitmap = bitmaps.get(fill.bitmap_id)
+        if bitmap is None:
+            bitmap = bitmaps[fill.bitmap_id] = self._get_bitmap(characters.get(fill.bitmap_id))
+        # bitmap pixels -> shape twips -> output pixels -> pixels of the box
+        matrix = transform.dot(np.diag([1 / TWIPS_PER_PIXEL, 1 / TWIPS_PER_PIXEL, 1])).dot(to_affine(fill.matrix))
+        matrix = np.array([[1, 0, -box[0]], [0, 1, -box[1]], [0, 0, 1]]).dot(matrix)
+        try:
+            inverse = np.linalg.inv(matrix)
+        except np.linalg.LinAlgError:
+            return
+        layer = bitmap.transform((box[2] - box[0], box[3] - box[1]), Image.AFFINE, tuple(inverse[:2].ravel()),
+                                 Image.BILINEAR if fill.smooth else Image.NEAREST)
+        alpha = np.asarray(mask, dtype=np.uint16) * np.asarray(layer.getchannel('A')) // 255
+        self._paste(canvas, box, layer.convert('RGB'), Image.fromarray(alpha.astype(np.uint8), 'L'), 1.0)
+
+    def _draw_stroke(self, canvas, stroke, transform, stage):
+        lines = list(filter(lambda x: len(x) >= 2, map(lambda x: flatten(x, transform), stroke.paths)))
+        # widths follow the scale of the shape, or of the stage only, hairlines are 1 pixel at any scale
+        scale = transform if stroke.scaled else stage
+        width = max(stroke.width * np.sqrt(abs(np.linalg.det(scale[:2, :2]))), 1.0)
+        box = self._box(canvas.size, lines, width)
+        if box is None:
+            return
+        ss = self.supersample
+        image = Image.new('L', ((box[2] - box[0]) * ss, (box[3] - box[1]) * ss), 0)
+        draw = ImageDraw.Draw(image)
+        r = width * ss / 2.0
+        for line in lines:
+            points = list(map(lambda p: ((p[0] - box[0]) * ss, (p[1] - box[1]) * ss), line))
+            draw.line(points, fill=255, width=int(round(width * ss)), joint='curve')
+            if stroke.round_caps:
+                for x, y in (points[0], points[-1]):
+                    draw.ellipse((x - r, y - r, x + r, y + r), fill=255)
+        mask = image.resize((box[2] - box[0], box[3] - box[1]), Image.BOX)
+        self._paste(canvas, box, to_rgb(stroke.color), mask, stroke.alpha)
+
+    @staticmethod
+    def _box(size, paths, pad):
+        # (left, top, right, bottom) of all points grown by pad, clipped to the canvas, None if nothing is inside
+        if not paths:
+            return None
+        points = np.vstack(list(map(np.array, paths)))
+        left, top = np.floor(points.min(axis=0) - pad).astype(int)
+        right, bottom = np.ceil(points.max(axis=0) + pad).astype(int) + 1
+        left, top = max(left, 0), max(top, 0)
+        right, bottom = min(right, size[0]), min(bottom, size[1])
+        if left >= right or top >= bottom:
+            return None
+        return int(left), int(top), int(right), int(bottom)
+
+    def _fill_mask(self, box, polygons):
+        # even-odd fill of all polygons as an 'L' image of the box, edges are anti-aliased
+        ss = self.supersample
+        size = ((box[2] - box[0]) * ss, (box[3] - box[1]) * ss)
+        mask = np.zeros((size[1], size[0]), dtype=bool)
+        for polygon in polygons:
+            image = Image.new('1', size, 0)
+            points = list(map(lambda p: ((p[0] - box[0]) * ss, (p[1] - box[1]) * ss), polygon))
+            ImageDraw.Draw(image).polygon(points, fill=1)
+            mask ^= np.asarray(image)
+        image = Image.fromarray(mask.astype(np.uint8) * 255, 'L')
+        return image.resize((box[2] - box[0], box[3] - box[1]), Image.BOX)
+
+    @staticmethod
+    def _paste(canvas, box, source, mask, alpha):
+        if alpha < 1.0:
+            mask = mask.point(lambda x: int(x * alpha))
+        canvas.paste(source, box, mask)
+
+    @staticmethod
+    def _get_bitmap(tag):
+        if tag is None or tag.name not in SwfRasterizer.bitmap_tags:
+            raise UnsupportedContent('bitmap')
+        tag.bitmapData.seek(0)
+        data = tag.bitmapData.read()
+        # erroneous header before swf 8
+        if data[:4] == b'\xff\xd9\xff\xd8':
+            data = data[4:]
+        image = Image.open(io.BytesIO(data))
+        image.load()
+        alpha = None
+        if tag.name == 'DefineBitsJPEG3':
+            tag.bitmapAlphaData.seek(0)
+            alpha = tag.bitmapAlphaData.read()
+        image = image.convert('RGBA')
+        if alpha and len(alpha) == image.width * image.height:
+            image.putalpha(Image.frombytes('L', image.size, alpha))
+        return image
+
+
+swf_rasterizer = SwfRasterizer()
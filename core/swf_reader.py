@@ -1,20 +1,28 @@
+import io
 import os
 import subprocess
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
+import click
 from PIL import Image
 from swf.movie import SWF
 
 from core.grf_reader import FFMPEG_FILE, FFMPEG_LOGLEVEL
-from utils.chrome_driver import ChromeDriver
+from core.swf_raster import SwfRasterizer, swf_rasterizer
+from utils.artifact_store import artifact_store
+from utils.chrome_driver import BrowserPool
 from utils.path import get_abs_path
 from utils.platform import get_sys_platform
-from utils.simple_server import index_page as INDEX_PAGE
-from utils.simple_server import start_server
-from utils.template_updater import template_updater
+from utils.simple_server import TemplateServer
 
 CHROMEDRIVER_PATH = '../executable/' + get_sys_platform() + '/chromedriver'
 CHROMEDRIVER_PATH = get_abs_path(__file__, CHROMEDRIVER_PATH)
 
+# part of the keys of stored pngs and mp4s, bump it when SwfRasterizer, the template, the capture or the encoding
+# changes, so that the store does not serve what was rendered before
+RENDER_VERSION = 2
+
 
 class SwfReader(object):
     def __init__(self):
@@ -58,14 +66,36 @@ class SwfReader(object):
 
     def get_shapes(self):
         tags = self.tags()
-        shapes = list(filter(lambda x: x.name in ('DefineShape3',), tags))
+        shapes = list(filter(lambda x: x.name in SwfRasterizer.shape_tags, tags))
         return shapes
 
 
+def rasterize_swf(filename, width, height):
+    # png bytes of the swf rendered by pyswf, None if it has to be rendered by chrome
+    try:
+        img = swf_rasterizer.render(SwfReader().read(filename), width, height)
+    except Exception:
+        # anything pyswf fails to parse is left to chrome
+        return None
+    if img is None:
+        return None
+    buffer = io.BytesIO()
+    img.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
 class SwfExporter(object):
-    def __init__(self, default_width=None, default_height=None):
+    def __init__(self, default_width=None, default_height=None, pool=None, fast_path=True, workers=1,
+                 store=artifact_store):
         self._default_width = default_width or 960
         self._default_height = default_height or 540
+        # chrome sessions reused by all exports, a one-off session is started if None
+        self._pool = pool
+        # slides made of shapes only are rendered without chrome, by processes if workers > 1
+        self._fast_path = fast_path
+        self._workers = workers
+        # pngs of swf files rendered before, by content and size, None to render everything
+        self._store = store
 
     @property
     def default_width(self):
@@ -76,47 +106,159 @@ class SwfExporter(object):
         return self._default_height
 
     # fixed window's scale problem in high dpi
-    def ensure_image_size(self, filename, width, height):
-        img = Image.open(filename)
-        if img.width != width or img.height != height:
-            img = img.resize((width, height), Image.ANTIALIAS)
-            img.save(filename)
-        img.close()
+    @staticmethod
+    def fit_png(png, width, height):
+        # png bytes of exactly width x height, the header is read only if the size is right already
+        img = Image.open(io.BytesIO(png))
+        if img.width == width and img.height == height:
+            return png
+        img = img.resize((width, height), getattr(Image, 'LANCZOS', None) or Image.ANTIALIAS)
+        buffer = io.BytesIO()
+        img.save(buffer, format='PNG')
+        return buffer.getvalue()
+
+    @staticmethod
+    def save_png(to, png):
+        with open(to, 'wb') as f:
+            f.write(png)
 
     def __call__(self, filename, to=None, width=None, height=None):
-        # cwd for save images
-        cwd = os.getcwd()
-        # update template
-        # first use default size, then resize to target size
-        template_updater(filename, width=self.default_width, height=self.default_height)
-        # start server
-        start_server()
-        # start chrome
-        cd = ChromeDriver(CHROMEDRIVER_PATH)
-        # open page
-        cd.get_flash_url(INDEX_PAGE)
-        # save to png
-        os.chdir(cwd)
+        self.export_all([(filename, to, width, height)])
+
+    def export_all(self, items, callback=None, sink=None):
+        """
+        :param items: [(swf filename, png filename or None, width, height)]
+        :param callback: called with each png filename when it is saved, in the order of items
+        :param sink: called with (png filename, png bytes) instead of writing the file, e.g. to encode video
+        """
+        sink = sink or self.save_png
+        pool = self._pool or BrowserPool(CHROMEDRIVER_PATH, 1)
+        raster = ProcessPoolExecutor(max_workers=self._workers) if self._fast_path and self._workers > 1 else None
+        # pages are rendered by a server of this export only, on an ephemeral port
+        try:
+            with TemplateServer() as server, ThreadPoolExecutor(max_workers=pool.size) as executor:
+                keys = list(map(lambda x: self._key(x[0], x[2], x[3]), items))
+                stored = list(map(lambda x: x is not None and self._store.get(x, '.png') is not None, keys))
+                # all slides are queued to the processes at once, chrome sessions take those they leave
+                rendered = list(map(lambda x: raster.submit(rasterize_swf, x[0][0], *self._size(x[0][2], x[0][3]))
+                                    if raster and not x[1] else None, zip(items, stored)))
+                futures = list(map(lambda x: executor.submit(self._export, pool, server, sink, *x[:2], *x[2]),
+                                   zip(keys, rendered, items)))
+                for future in futures:
+                    to = future.result()
+                    if callback:
+                        callback(to)
+        finally:
+            if raster is not None:
+                raster.shutdown()
+            if pool is not self._pool:
+                pool.close()
+
+    def _size(self, width=None, height=None):
+        return int(width or self.default_width), int(height or self.default_height)
+
+    def _key(self, filename, width=None, height=None):
+        if self._store is None:
+            return None
+        # pngs of chrome and of the rasterizer are stored apart
+        return self._store.key(filename, 'png', RENDER_VERSION, self._size(width, height), self._fast_path)
+
+    def _export(self, pool, server, sink, key, rendered, filename, to=None, width=None, height=None):
         if not to:
             to = filename[:filename.rindex('.')] + '.png'
-        cd.save_screenshot(to)
-        # ensure image size
-        self.ensure_image_size(to, int(width), int(height))
-        cd.quit_driver()
+        png = self._store.load(key, '.png') if key is not None else None
+        if png is None:
+            png = rendered.result() if rendered is not None else self.rasterize(filename, width, height)
+            if png is None:
+                png = self.capture(pool, server, filename, width, height)
+            if key is not None:
+                self._store.save(key, '.png', png)
+        sink(to, png)
+        return to
+
+    def rasterize(self, filename, width=None, height=None):
+        if not self._fast_path:
+            return None
+        return rasterize_swf(filename, *self._size(width, height))
+
+    def capture(self, pool, server, filename, width=None, height=None):
+        # png bytes of the swf rendered at width x height, nothing is written to disk
+        width, height = self._size(width, height)
+        with pool.session() as cd:
+            cd.get_flash_url(server.page_url(filename, width, height))
+            png = cd.get_screenshot_as_png()
+        return self.fit_png(png, width, height)
 
 
 class PngTransformer(object):
-    def __init__(self, loglevel=FFMPEG_LOGLEVEL):
+    def __init__(self, loglevel=FFMPEG_LOGLEVEL, store=artifact_store):
         self._loglevel = loglevel
+        # mp4s encoded before, by png content and duration, None to encode everything
+        self._store = store
 
     def __call__(self, filename, output=None, duration_s='1'):
         if not output:
             output = filename[: filename.rindex('.')] + '.mp4'
 
+        key = self._store.key(filename, 'mp4', RENDER_VERSION, '%.3f' % float(duration_s)) \
+            if self._store is not None else None
+        if key is not None and self._store.fetch(key, '.mp4', output):
+            return
+
         # refer: https://stackoverflow.com/questions/20847674/ffmpeg-libx264-height-not-divisible-by-2
         parameters = [FFMPEG_FILE, '-framerate', '1', '-loop', '1', '-i', filename,
                       '-c:v', 'libx264', '-tune', 'stillimage', '-r', '10', '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2',
                       '-pix_fmt', 'yuv420p', '-strict', '-2', '-loglevel', self._loglevel,
                       '-t', duration_s, '-y', output]
 
-        subprocess.call(parameters)
+        if subprocess.call(parameters) == 0 and key is not None:
+            self._store.put(key, '.mp4', output)
+
+    def encode_track(self, pages, output, width=None, height=None):
+        """
+        encode all pages into one mp4 in a single pass, no mp4 is written per page.
+        :param pages: [(png filename, duration in seconds)], in the order of the track
+        :param width: of the track, pages of other sizes are fitted and padded, the first page's by default
+        pages of no duration are never shown, they are left out and reported.
+        """
+        for filename, duration in pages:
+            if float(duration) <= 0:
+                click.echo('%s is left out of %s, its duration is %s' % (filename, output, duration), err=True)
+        pages = list(filter(lambda x: float(x[1]) > 0, pages))
+        if not pages:
+            return
+        if not width or not height:
+            with Image.open(pages[0][0]) as img:
+                width, height = img.size
+        # libx264 needs even sizes
+        width, height = int(width) + int(width) % 2, int(height) + int(height) % 2
+
+        fd, list_file = tempfile.mkstemp(suffix='.ffconcat')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.make_ffconcat(pages))
+            vf = 'scale={0}:{1}:force_original_aspect_ratio=decrease,pad={0}:{1}:(ow-iw)/2:(oh-ih)/2'.format(
+                width, height)
+            # frames are repeated at 10 fps up to the next page, -frames:v cuts the tail of the last one.
+            # not -t, which stops reading at that time, before the entry closing the last page
+            duration = sum(map(lambda x: float(x[1]), pages))
+            frames = max(int(round(duration * 10)), 1)
+            parameters = [FFMPEG_FILE, '-f', 'concat', '-safe', '0', '-i', list_file,
+                          '-c:v', 'libx264', '-tune', 'stillimage', '-vf', vf, '-r', '10', '-frames:v', str(frames),
+                          '-pix_fmt', 'yuv420p', '-strict', '-2', '-loglevel', self._loglevel, '-y', output]
+            subprocess.call(parameters)
+        finally:
+            os.remove(list_file)
+
+    @staticmethod
+    def make_ffconcat(pages):
+        def escape(filename):
+            return os.path.abspath(filename).replace("'", "'\\''")
+
+        lines = ['ffconcat version 1.0']
+        for filename, duration in pages:
+            lines.append("file '{}'".format(escape(filename)))
+            lines.append('duration %.3f' % float(duration))
+        # the duration of the last file is only used if it is followed by another entry
+        lines.append("file '{}'".format(escape(pages[-1][0])))
+        return '\n'.join(lines) + '\n'
@@ -1,65 +1,117 @@
+import codecs
 import json
 import os
+import pickle
+import re
+from bisect import bisect_right
+from functools import lru_cache
 from xml.etree.ElementTree import ParseError, Element
-from xml.etree.ElementTree import parse, fromstring
+from xml.etree.ElementTree import parse, fromstring, iterparse
+
+import numpy as np
+
+from utils.digest import file_digest
+from utils.timestamp import timestamp2frame
+
+# bump it when the parsed result of RecordXml changes, to invalidate old cache files
+RECORD_CACHE_VERSION = 1
+# parsed records are pickled into a folder of the user, never next to the data, which may come from anywhere
+RECORD_CACHE_FOLDER = os.path.join(os.path.expanduser('~'), '.3to1', 'records')
+
+# invalid characters in xml 1.0, some recordings contain them
+control_character_pattern = re.compile("[\x00-\x08\x0b-\x0c\x0e-\x1f]+")
+
+
+def to_float(v):
+    # keep the raw value if it is not a number, e.g. ''
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return v
+
+
+def to_int(v):
+    try:
+        return int(v)
+    except (TypeError, ValueError):
+        try:
+            return int(float(v))
+        except (TypeError, ValueError):
+            return v
+
+
+def to_points(texts):
+    # ['x,y', ...] -> int32 array of shape (n, 2), truncated like int(float(x))
+    if not texts:
+        return np.empty((0, 2), dtype=np.int32)
+    try:
+        return np.array(','.join(texts).split(','), dtype=np.float64).reshape(-1, 2).astype(np.int32)
+    except ValueError:
+        # skip broken pairs
+        points = []
+        for text in texts:
+            try:
+                x, y = map(float, text.split(','))
+            except ValueError:
+                continue
+            points.append((x, y))
+        return np.array(points, dtype=np.float64).reshape(-1, 2).astype(np.int32)
+
+
+@lru_cache(maxsize=None)
+def get_fields(cls):
+    # all slots along mro, base class first
+    names = []
+    for klass in reversed(cls.__mro__):
+        names.extend(klass.__dict__.get('__slots__', ()))
+    return tuple(names)
+
+
+@lru_cache(maxsize=None)
+def get_attribute_map(cls):
+    # field name -> converter, None means keeping the string
+    converters = {}
+    for klass in reversed(cls.__mro__):
+        converters.update(klass.__dict__.get('converters', {}))
+    return tuple((name, converters.get(name)) for name in get_fields(cls))
 
 
 class Base(object):
+    __slots__ = ()
+    # numeric fields are converted once at loading
+    converters = {}
+
+    def __init__(self, **kwargs):
+        for name in get_fields(self.__class__):
+            setattr(self, name, kwargs.get(name, ''))
+
     def __str__(self):
-        ds = dir(self)
-        # filter
-        ds = list(filter(lambda x: not x.startswith('__') and not x.endswith('__'), ds))
         # sort
-        ds = sorted(ds)
+        ds = sorted(get_fields(self.__class__))
         # print
         s = ', '.join(list(map(lambda x: '%s=%s' % (x, getattr(self, x)), ds)))
         return '%s(%s)' % (self.__class__.__name__, s)
 
 
 class Conf(Base):
-    annofile = ''
-    audiocodec = ''
-    avstarttime = ''
-    chatfile = ''
-    # continue = ''
-    duration = ''
-    endtime = ''
-    hls = ''
-    hlsaudioonly = ''
-    id = ''
-    js = ''
-    jsanno = ''
-    jschat = ''
-    kbps = ''
-    name = ''
-    novideo = ''
-    starttime = ''
-    storage = ''
-    ver = ''
-    videoheight = ''
-    videowidth = ''
+    __slots__ = ('annofile', 'audiocodec', 'avstarttime', 'chatfile',
+                 # 'continue',
+                 'duration', 'endtime', 'hls', 'hlsaudioonly', 'id', 'js', 'jsanno', 'jschat', 'kbps',
+                 'name', 'novideo', 'starttime', 'storage', 'ver', 'videoheight', 'videowidth')
+    converters = dict(duration=to_float, videoheight=to_int, videowidth=to_int)
 
 
 class Document(Base):
-    name = ''
-    id = ''
-    type = ''
-    timestamp = ''
+    __slots__ = ('name', 'id', 'type', 'timestamp')
+    converters = dict(timestamp=to_float)
 
 
 class Page(Base):
-    id = ''
-    title = ''
-    content = ''
-    height = ''
-    width = ''
-    starttimestamp = ''
-    speedup = ''
-    step = ''
-    stoptimestamp = ''
-    hls = ''
-    # add unique id, auto increase from 0, since some swf files are used more than once.
-    uid = ''
+    __slots__ = ('id', 'title', 'content', 'height', 'width', 'starttimestamp', 'speedup', 'step',
+                 'stoptimestamp', 'hls',
+                 # add unique id, auto increase from 0, since some swf files are used more than once.
+                 'uid')
+    converters = dict(height=to_int, width=to_int, starttimestamp=to_float, stoptimestamp=to_float)
 
     # update uid
     def update_uid(self, uid):
@@ -68,73 +120,136 @@ class Page(Base):
 
 
 class Command(Base):
-    type = ''
-    frameIdx = ''
-    timestamp = ''
-    documentid = ''
-    pageid = ''
+    __slots__ = ('type', 'frameIdx', 'timestamp', 'documentid', 'pageid')
+    converters = dict(frameIdx=to_int, timestamp=to_float)
 
 
 class MultiRecord(Base):
-    starttimestamp = ''
-    stoptimestamp = ''
-    duration = ''
-    multimedia = ''
-    filesize = ''
-    havevideo = ''
-    chat = ''
-    jschat = ''
+    __slots__ = ('starttimestamp', 'stoptimestamp', 'duration', 'multimedia', 'filesize', 'havevideo',
+                 'chat', 'jschat')
+    converters = dict(starttimestamp=to_float, stoptimestamp=to_float, duration=to_float, filesize=to_int)
 
 
 class Event(Base):
-    type = ''
-    timestamp = ''
-    totaltimestamp = ''
+    __slots__ = ('type', 'timestamp', 'totaltimestamp')
+    converters = dict(timestamp=to_float, totaltimestamp=to_float)
+    # columns of Timeline
+    dtypes = dict(timestamp=np.float64, totaltimestamp=np.float64)
 
 
 class Content(Base):
-    document = ''
-    page = ''
-    speedup = ''
-    step = ''
-    videotype = ''
-    width = ''
-    height = ''
+    __slots__ = ('document', 'page', 'speedup', 'step', 'videotype', 'width', 'height')
+    converters = dict(width=to_int, height=to_int)
 
 
 class AnnoCommand(Base):
-    id = ''
-    type = ''
-    timestamp = ''
-    documentid = ''
-    pageid = ''
-    color = ''
-    linesize = ''
-    p = ''
-    removed = ''
-    tail = ''  # <![CDATA[xxxx]]> --> xxxx
+    __slots__ = ('id', 'type', 'timestamp', 'documentid', 'pageid', 'color', 'linesize', 'removed',
+                 'tail',  # <![CDATA[xxxx]]> --> xxxx
+                 'points',  # <p>x,y</p>... --> int32 array of shape (n, 2)
+                 'frame',  # frame index of timestamp, '' if fps is unknown
+                 )
+    converters = dict(timestamp=to_float, linesize=to_int)
 
 
 class Chat(Base):
-    timestamp = ''
-    utctime = ''
-    type = ''
-    id = ''
-    group = ''
-    sender = ''
-    groupid = ''
-    senderid = ''
-    senderId = ''
-    content = ''
+    __slots__ = ('timestamp', 'utctime', 'type', 'id', 'group', 'sender', 'groupid', 'senderid', 'senderId',
+                 'content')
+    converters = dict(timestamp=to_float)
 
 
 class AudioIndex(Base):
-    timestamp = ''
-    filepos = ''
+    __slots__ = ('timestamp', 'filepos')
+    converters = dict(timestamp=to_float, filepos=to_int)
+    dtypes = dict(timestamp=np.float64, filepos=np.int64)
 
 
 class VideoKey(AudioIndex):
-    isconfig = ''
+    __slots__ = ('isconfig',)
+    converters = dict(isconfig=to_int)
+    dtypes = dict(isconfig=np.int64)
+
+
+@lru_cache(maxsize=None)
+def get_dtypes(cls):
+    dtypes = {}
+    for klass in reversed(cls.__mro__):
+        dtypes.update(klass.__dict__.get('dtypes', {}))
+    return dtypes
+
+
+class TimelineBuilder(object):
+    # collect raw attributes, then convert them to columns at once
+    def __init__(self, cls):
+        self._cls = cls
+        self._values = {name: [] for name in get_dtypes(cls)}
+
+    def append(self, attrib):
+        for name, values in self._values.items():
+            values.append(attrib.get(name, ''))
+
+    def build(self):
+        columns = {}
+        for name, dtype in get_dtypes(self._cls).items():
+            # missing values: nan for float, -1 for integer
+            if np.issubdtype(dtype, np.floating):
+                values = [float(v) if v else np.nan for v in self._values[name]]
+            else:
+                values = [int(float(v)) if v else -1 for v in self._values[name]]
+            columns[name] = np.array(values, dtype=dtype)
+        return Timeline(self._cls, columns)
+
+
+class Timeline(object):
+    """
+    columnar records sorted by timestamp,
+    lookups are vectorized, t can be a scalar or an array of timestamps.
+    """
+
+    def __init__(self, cls, columns):
+        self._cls = cls
+        order = np.argsort(columns['timestamp'], kind='mergesort')
+        self._columns = {name: column[order] for name, column in columns.items()}
+
+    @classmethod
+    def from_elements(cls, record_cls, elements):
+        builder = TimelineBuilder(record_cls)
+        for element in elements:
+            builder.append(element.attrib)
+        return builder.build()
+
+    def __len__(self):
+        return len(self._columns['timestamp'])
+
+    def __getitem__(self, index):
+        # record object, like the ones from init_obj_using_attrib()
+        return self._cls(**{name: column[index].item() for name, column in self._columns.items()})
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def column(self, name):
+        return self._columns[name]
+
+    @property
+    def timestamp(self):
+        return self._columns['timestamp']
+
+    @property
+    def filepos(self):
+        return self._columns['filepos']
+
+    def index_at(self, t):
+        # index of the last record at or before t, -1 if t is before the first one
+        return np.searchsorted(self.timestamp, t, side='right') - 1
+
+    def filepos_at(self, t):
+        # file position of the nearest record at or before t, -1 if none
+        index = self.index_at(t)
+        return np.where(index >= 0, self.filepos[np.maximum(index, 0)], -1) if len(self) else np.full_like(
+            index, -1)
+
+    def to_dict(self):
+        return {name: column.tolist() for name, column in self._columns.items()}
 
 
 class CustomEncoder(json.JSONEncoder):
@@ -144,20 +259,60 @@ class CustomEncoder(json.JSONEncoder):
             return str(o)
         elif isinstance(o, Element):
             return o.text
+        elif isinstance(o, Timeline):
+            return o.to_dict()
         return super(CustomEncoder, self).default(o)
 
 
-def init_obj_using_attrib_by_exec(cls, obj, exclusive_keys=[]):
-    ins = cls()
+def init_obj_using_attrib(cls, obj, exclusive_keys=()):
+    # unknown attributes are dropped, since records are slotted
+    ins = cls.__new__(cls)
+    attrib = obj.attrib
 
-    [exec('ins.%s = v' % k, dict(ins=ins, v=v)) for k, v in obj.attrib.items() if k not in exclusive_keys]
+    for name, converter in get_attribute_map(cls):
+        if name in attrib and name not in exclusive_keys:
+            v = attrib[name]
+            setattr(ins, name, converter(v) if converter else v)
+        else:
+            setattr(ins, name, '')
 
     return ins
 
 
+class CleanStream(object):
+    """
+    file-like object for iterparse,
+    decode as utf-8 and remove control characters chunk by chunk.
+    """
+
+    def __init__(self, filename, chunk_size=64 * 1024):
+        self._file = open(filename, 'rb')
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+        self._chunk_size = chunk_size
+        self._position = 0
+
+    def read(self, size=-1):
+        size = size if size and size > 0 else self._chunk_size
+        while True:
+            data = self._file.read(size)
+            s = self._decoder.decode(data, final=not data)
+            s = control_character_pattern.sub('', s)
+            # empty result means eof only when nothing is left in file
+            if s or not data:
+                return s.encode(u'utf-8')
+
+    def tell(self):
+        return self._position if self._file.closed else self._file.tell()
+
+    def close(self):
+        self._position = self._file.tell()
+        self._file.close()
+
+
 class XmlReader(object):
     def __init__(self):
         self._xml = None
+        self._stream = None
         self.data = []
 
     def read(self, filename):
@@ -166,13 +321,44 @@ class XmlReader(object):
         try:
             self._xml = parse(filename)
         except ParseError:
-            import re
             s = open(filename, 'rb').read().decode(encoding='utf-8', errors='ignore')
-            s = re.sub("[\x00-\x08\x0b-\x0c\x0e-\x1f]+", "", s)
+            s = control_character_pattern.sub("", s)
             self._xml = fromstring(s.encode(u'utf-8'))
 
         return self._xml
 
+    def iterparse(self, filename, events=('start', 'end')):
+        # incremental counterpart of read(), control characters are removed while streaming
+        assert os.path.exists(filename)
+
+        self._stream = CleanStream(filename)
+        try:
+            for event, elem in iterparse(self._stream, events=events):
+                yield event, elem
+        finally:
+            self._stream.close()
+
+    def iterchildren(self, filename):
+        # yield direct children of root one by one, each child is removed after being consumed
+        root = None
+        depth = 0
+        for event, elem in self.iterparse(filename):
+            if event == 'start':
+                if root is None:
+                    root = elem
+                depth += 1
+                continue
+            depth -= 1
+            if depth == 1:
+                yield elem
+                elem.clear()
+                root.remove(elem)
+
+    @property
+    def position(self):
+        # bytes consumed by iterparse
+        return self._stream.tell() if self._stream else 0
+
     def parse(self):
         pass
 
@@ -186,21 +372,33 @@ class AnnoXml(XmlReader):
         super(AnnoXml, self).__init__()
         self._command = []
 
-    def parse(self):
+    def parse(self, fps=None):
         if not self._xml:
             return
         # root
         root = self._xml.getroot()
-        cs = []
-        for child in root.getchildren():
-            # update attrib to call init_obj_using_attrib_by_exec()
-            child.attrib.update({'p': ','.join(map(lambda x: '(' + x.text + ')', child.getchildren())),
-                                 'tail': list(filter(lambda y: y, map(lambda x: x.tail, child.getchildren())))[0]
-                                 if list(filter(lambda y: y, map(lambda x: x.tail, child.getchildren()))) else ''})
-            c = init_obj_using_attrib_by_exec(AnnoCommand, child)
-            cs.append(c)
+        self._command = list(map(lambda x: self._make_command(x, fps), root.getchildren()))
+
+    def iter_command(self, filename, fps=None):
+        # streaming mode, commands are yielded as soon as they are read
+        for child in self.iterchildren(filename):
+            yield self._make_command(child, fps)
 
-        self._command = cs
+    def stream(self, filename, fps=None):
+        self._command = list(self.iter_command(filename, fps))
+
+    @staticmethod
+    def _make_command(child, fps=None):
+        children = list(child)
+        tails = list(filter(lambda y: y, map(lambda x: x.tail, children)))
+        # update attrib to call init_obj_using_attrib()
+        child.attrib['tail'] = tails[0] if tails else ''
+        command = init_obj_using_attrib(AnnoCommand, child, exclusive_keys=('points', 'frame'))
+        # points are parsed once here
+        command.points = to_points(list(map(lambda x: x.text or '', children)))
+        if fps and command.timestamp != '':
+            command.frame = timestamp2frame(command.timestamp, fps)
+        return command
 
     @property
     def command(self):
@@ -221,14 +419,21 @@ class ChatXml(XmlReader):
         except:
             root = self._xml.getchildren()
 
-        cs = []
-        for child in root:
-            child.attrib.update(child.getchildren()[0].attrib)
-            child.attrib.update({'content': child.getchildren()[0].getchildren()[0].text})
-            c = init_obj_using_attrib_by_exec(Chat, child)
-            cs.append(c)
+        self._chat = list(map(self._make_chat, root))
+
+    def iter_chat(self, filename):
+        # streaming mode, chats are yielded as soon as they are read
+        for child in self.iterchildren(filename):
+            yield self._make_chat(child)
 
-        self._chat = cs
+    def stream(self, filename):
+        self._chat = list(self.iter_chat(filename))
+
+    @staticmethod
+    def _make_chat(child):
+        child.attrib.update(child[0].attrib)
+        child.attrib.update({'content': child[0][0].text})
+        return init_obj_using_attrib(Chat, child)
 
     @property
     def chat(self):
@@ -257,13 +462,16 @@ class RecordXml(XmlReader):
 
         self.multirecord = None
 
+        # memoized views, see _memoize()
+        self._views = {}
+
     def parse(self):
         if not self._xml:
             return
         root = self._xml.getroot()
         self.attributes = root.attrib
 
-        self.conf = init_obj_using_attrib_by_exec(Conf, root, exclusive_keys=['continue'])
+        self.conf = init_obj_using_attrib(Conf, root, exclusive_keys=['continue'])
 
         # animationsetting, document, document action, multirecord
         modules = root.getchildren()
@@ -286,20 +494,15 @@ class RecordXml(XmlReader):
 
         documents = self.document.getchildren()
 
-        ret = []
-        for document in documents:
-
-            d = init_obj_using_attrib_by_exec(Document, document)
+        self.document = list(map(self._make_document, documents))
 
-            pages = document.getchildren()
+    @staticmethod
+    def _make_document(document):
+        d = init_obj_using_attrib(Document, document)
 
-            ps = []
-            for page in pages:
-                p = init_obj_using_attrib_by_exec(Page, page)
-                ps.append(p)
+        ps = list(map(lambda page: init_obj_using_attrib(Page, page), document))
 
-            ret.append(dict(document=d, page=ps))
-        self.document = ret
+        return dict(document=d, page=ps)
 
     def _parse_document_action(self):
 
@@ -310,7 +513,7 @@ class RecordXml(XmlReader):
 
         cs = []
         for command in commands:
-            c = init_obj_using_attrib_by_exec(Command, command)
+            c = init_obj_using_attrib(Command, command)
 
             cs.append(c)
 
@@ -327,11 +530,12 @@ class RecordXml(XmlReader):
 
         for multirecord in multirecords:
 
-            m = init_obj_using_attrib_by_exec(MultiRecord, multirecord)
+            m = init_obj_using_attrib(MultiRecord, multirecord)
 
             es = []
-            ads = []
-            vks = []
+            ads = Timeline.from_elements(AudioIndex, [])
+            vks = Timeline.from_elements(VideoKey, [])
+            eis = Timeline.from_elements(Event, [])
 
             for child in multirecord.getchildren():
                 tag = child.tag
@@ -340,42 +544,151 @@ class RecordXml(XmlReader):
                     # events
                     events = child.getchildren()
                     for event in events:
-                        e = init_obj_using_attrib_by_exec(Event, event)
-
-                        contents = event.getchildren()
-
-                        cs = []
-                        for content in contents:
-                            c = init_obj_using_attrib_by_exec(Content, content)
-
-                            cs.append(c)
-
-                        es.append(dict(event=e, content=cs))
+                        es.append(self._make_event(event))
+                    eis = Timeline.from_elements(Event, events)
 
                 elif tag == 'audioindexs':
                     # audioindex
-                    audioindexs = child.getchildren()
-                    for audioindex in audioindexs:
-                        a = init_obj_using_attrib_by_exec(AudioIndex, audioindex)
-
-                        ads.append(a)
+                    ads = Timeline.from_elements(AudioIndex, child.getchildren())
 
                 elif tag == 'videokeys':
                     # videokey
-                    videokeys = child.getchildren()
-                    for videokey in videokeys:
-                        vk = init_obj_using_attrib_by_exec(VideoKey, videokey)
+                    vks = Timeline.from_elements(VideoKey, child.getchildren())
+            result.append(dict(multirecord=m, events=es, audioindex=ads, videokey=vks, eventindex=eis))
+        self.multirecord = result
 
-                        vks.append(vk)
+    @staticmethod
+    def _make_event(event):
+        e = init_obj_using_attrib(Event, event)
+
+        cs = list(map(lambda content: init_obj_using_attrib(Content, content), event))
+
+        return dict(event=e, content=cs)
+
+    def iter_record(self, filename):
+        """
+        streaming counterpart of read() + parse(),
+        yield Command and event dict as soon as they are read,
+        attributes are filled in the same way as parse() when exhausted.
+        """
+        # document and multirecord are filled in place
+        self._views = {}
+        # elements from root to current one
+        path = []
+        module = None
+        builders = {}
+        for event, elem in self.iterparse(filename):
+            if event == 'start':
+                path.append(elem)
+                depth = len(path)
+                if depth == 1:
+                    self.attributes = elem.attrib
+                    self.conf = init_obj_using_attrib(Conf, elem, exclusive_keys=['continue'])
+                elif depth == 2:
+                    module = elem.attrib.get('name').replace(' ', '_')
+                    if module in ('document', 'document_action', 'multirecord'):
+                        setattr(self, module, [] if module != 'document_action' else dict(command=[]))
+                    else:
+                        # keep the raw element, like parse()
+                        setattr(self, module, elem)
+                elif depth == 3 and module == 'multirecord':
+                    self.multirecord.append(dict(multirecord=init_obj_using_attrib(MultiRecord, elem), events=[]))
+                    builders = dict(audioindex=TimelineBuilder(AudioIndex), videokey=TimelineBuilder(VideoKey),
+                                    eventindex=TimelineBuilder(Event))
+                continue
+
+            depth = len(path)
+            path.pop()
+            parent = path[-1] if path else None
+
+            if depth == 3 and module == 'document':
+                self.document.append(self._make_document(elem))
+            elif depth == 3 and module == 'document_action':
+                c = init_obj_using_attrib(Command, elem)
+                self.document_action['command'].append(c)
+                yield c
+            elif depth == 3 and module == 'multirecord':
+                self.multirecord[-1].update({name: builder.build() for name, builder in builders.items()})
+            elif depth == 5 and module == 'multirecord':
+                tag = elem.tag
+                if tag == 'event':
+                    e = self._make_event(elem)
+                    self.multirecord[-1]['events'].append(e)
+                    builders['eventindex'].append(elem.attrib)
+                    yield e
+                elif tag in ('audioindex', 'videokey'):
+                    builders[tag].append(elem.attrib)
+            else:
+                continue
+            # release parsed element
+            elem.clear()
+            parent.remove(elem)
+
+    def stream(self, filename):
+        for _ in self.iter_record(filename):
+            pass
+
+    def load(self, filename, cache=True, folder=RECORD_CACHE_FOLDER):
+        """
+        stream() with a binary cache in folder named by the content hash of filename,
+        the cache is used only if both content hash and RECORD_CACHE_VERSION match.
+        """
+        if not cache:
+            self.stream(filename)
+            return self
+
+        key = dict(version=RECORD_CACHE_VERSION, digest=file_digest(filename))
+        cache_file = os.path.join(folder, key['digest'] + '.cache')
+        if not self._load_cache(cache_file, key):
+            self.stream(filename)
+            self._dump_cache(cache_file, key)
+        return self
 
-                else:
-                    print(tag)
-                    pass
-            result.append(dict(multirecord=m, events=es, audioindex=ads, videokey=vks))
-        self.multirecord = result
+    # parsed result to be cached
+    _cache_fields = ('attributes', 'conf', 'animationsetting', 'document', 'document_action', 'multirecord')
+
+    def _load_cache(self, cache_file, key) -> bool:
+        if not os.path.exists(cache_file):
+            return False
+        try:
+            with open(cache_file, 'rb') as f:
+                # key first, so that a stale cache is rejected without loading the whole state
+                if pickle.load(f) != key:
+                    return False
+                state = pickle.load(f)
+        except Exception:
+            return False
+        for name in self._cache_fields:
+            setattr(self, name, state[name])
+        return True
+
+    def _dump_cache(self, cache_file, key):
+        state = {name: getattr(self, name) for name in self._cache_fields}
+        tmp_file = '%s.%d.tmp' % (cache_file, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            with open(tmp_file, 'wb') as f:
+                pickle.dump(key, f, protocol=pickle.HIGHEST_PROTOCOL)
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file, cache_file)
+        except OSError:
+            # cache is optional, e.g. read-only folder
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+    def _memoize(self, name, source, build):
+        # views are rebuilt only when their source is replaced, e.g. by parse() or load()
+        cached = self._views.get(name)
+        if cached is None or cached[0] is not source:
+            cached = (source, build())
+            self._views[name] = cached
+        return cached[1]
 
     @property
     def grfs(self):
+        return self._memoize('grfs', self.multirecord, self._make_grfs)
+
+    def _make_grfs(self):
         if not self.multirecord:
             return []
 
@@ -388,6 +701,13 @@ class RecordXml(XmlReader):
             height=self.videoheight,
         ), self.multirecord))
 
+    def keyframe_filepos(self, index, t):
+        # file position of the nearest video key at or before t, to seek into the index-th grf file
+        return self.multirecord[index]['videokey'].filepos_at(t)
+
+    def audio_filepos(self, index, t):
+        return self.multirecord[index]['audioindex'].filepos_at(t)
+
     @property
     def videowidth(self):
         return self.conf.videowidth
@@ -398,6 +718,9 @@ class RecordXml(XmlReader):
 
     @property
     def pages(self):
+        return self._memoize('pages', self.document, self._make_pages)
+
+    def _make_pages(self):
         if not self.document:
             return []
         pages = list(map(lambda x: x['page'], self.document))
@@ -408,6 +731,9 @@ class RecordXml(XmlReader):
 
     @property
     def swfs(self):
+        return self._memoize('swfs', self.document, self._make_swfs)
+
+    def _make_swfs(self):
         if not self.document:
             return []
         return list(map(lambda x: dict(
@@ -421,3 +747,41 @@ class RecordXml(XmlReader):
             # unique filename
             ufilename='{uid}-{content}'.format(uid=x.uid, content=x.content)
         ), self.pages))
+
+    @property
+    def page_index(self):
+        # (documentid, pageid) -> page
+        return self._memoize('page_index', self.document, lambda: {
+            (d['document'].id, p.id): p for d in (self.document or []) for p in d['page']
+        })
+
+    def page_by_id(self, documentid, pageid):
+        return self.page_index.get((documentid, pageid))
+
+    def page_by_uid(self, uid):
+        pages = self.pages
+        return pages[uid] if 0 <= uid < len(pages) else None
+
+    @staticmethod
+    def _make_timeline(items, get_start):
+        # (sorted start timestamps, items in the same order), items without start are skipped
+        items = [item for item in items if isinstance(get_start(item), float)]
+        items = sorted(items, key=get_start)
+        return list(map(get_start, items)), items
+
+    def _active_at(self, timeline, t):
+        starts, items = timeline
+        index = bisect_right(starts, float(t)) - 1
+        return items[index] if index >= 0 else None
+
+    def page_at(self, t):
+        # the last page started at or before t
+        timeline = self._memoize('page_timeline', self.document,
+                                 lambda: self._make_timeline(self.pages, lambda x: x.starttimestamp))
+        return self._active_at(timeline, t)
+
+    def grf_at(self, t):
+        # the last grf segment started at or before t
+        timeline = self._memoize('grf_timeline', self.multirecord,
+                                 lambda: self._make_timeline(self.grfs, lambda x: x['starttimestamp']))
+        return self._active_at(timeline, t)
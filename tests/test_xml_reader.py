@@ -0,0 +1,35 @@
+import numpy as np
+
+from core.xml_reader import AnnoXml, to_points
+
+ANNO_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<anno>
+<c id="1" type="2" timestamp="1.2" documentid="1" pageid="1" color="#0000ff,1" linesize="2"><p>1.5,2.5</p><p>10.75,20.0</p></c>
+<c id="2" type="2" timestamp="2.5" documentid="1" pageid="1" color="#ff0000" linesize="1"><p>225,5</p><p>7,300</p></c>
+</anno>
+'''
+
+
+def test_to_points_decimal():
+    points = to_points(['1.5,2.5', '10.75,20.0'])
+    assert points.dtype == np.int32
+    assert points.tolist() == [[1, 2], [10, 20]]
+
+
+def test_to_points_integer():
+    # single digit integers were dropped by the regex parser before
+    assert to_points(['225,5', '7,300']).tolist() == [[225, 5], [7, 300]]
+
+
+def test_to_points_skips_broken_pairs():
+    assert to_points(['1,2', 'x,3', '4', '5.5,6']).tolist() == [[1, 2], [5, 6]]
+    assert to_points([]).shape == (0, 2)
+
+
+def test_anno_xml_points(tmp_path):
+    filename = tmp_path / 'anno.xml'
+    filename.write_text(ANNO_XML)
+    commands = list(AnnoXml().iter_command(str(filename), fps=10))
+    assert commands[0].points.tolist() == [[1, 2], [10, 20]]
+    assert commands[1].points.tolist() == [[225, 5], [7, 300]]
+    assert commands[1].frame == 25
@@ -0,0 +1,129 @@
+import hashlib
+import os
+import shutil
+import threading
+
+from utils.digest import file_digest
+
+ARTIFACT_FOLDER = os.path.join(os.path.expanduser('~'), '.3to1', 'artifacts')
+ARTIFACT_MAX_BYTES = 4 * 1024 * 1024 * 1024
+
+
+class ArtifactStore(object):
+    """
+    rendered files keyed by the digest of their source and the parameters of the rendering,
+    shared by all records, so courseware used again is not rendered again.
+    least recently used files are removed when the folder grows over max_bytes.
+    """
+
+    def __init__(self, folder=ARTIFACT_FOLDER, max_bytes=ARTIFACT_MAX_BYTES):
+        self._folder = folder
+        self._max_bytes = max_bytes
+        # bytes in the folder, counted on the first write
+        self._size = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(filename, *params):
+        # None if filename can not be read, it is rendered without the store then
+        try:
+            digest = file_digest(filename)
+        except OSError:
+            return None
+        h = hashlib.sha1(digest.encode('ascii'))
+        h.update(repr(params).encode('utf-8'))
+        return h.hexdigest()
+
+    def path(self, key, ext):
+        return os.path.join(self._folder, key[:2], key + ext)
+
+    def get(self, key, ext):
+        # path of the artifact or None, a hit becomes the most recently used
+        path = self.path(key, ext)
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def load(self, key, ext):
+        path = self.get(key, ext)
+        if path is None:
+            return None
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def fetch(self, key, ext, to) -> bool:
+        # copy the artifact to `to`, False if it is not stored
+        path = self.get(key, ext)
+        if path is None:
+            return False
+        try:
+            shutil.copyfile(path, to)
+        except OSError:
+            return False
+        return True
+
+    def save(self, key, ext, data):
+        self._write(key, ext, lambda f: f.write(data))
+
+    def put(self, key, ext, filename):
+        def copy(f):
+            with open(filename, 'rb') as src:
+                shutil.copyfileobj(src, f)
+
+        self._write(key, ext, copy)
+
+    def _write(self, key, ext, write):
+        path = self.path(key, ext)
+        tmp_file = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_file, 'wb') as f:
+                write(f)
+            os.replace(tmp_file, path)
+            size = os.path.getsize(path)
+        except OSError:
+            # store is optional
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            return
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan()[1]
+            else:
+                self._size += size
+            if self._size > self._max_bytes:
+                self._evict()
+
+    def _scan(self):
+        # ([(mtime, size, path)], total size) of stored files
+        entries = []
+        for root, _, files in os.walk(self._folder):
+            for name in files:
+                if name.endswith('.tmp'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries, sum(map(lambda x: x[1], entries))
+
+    def _evict(self):
+        entries, self._size = self._scan()
+        for mtime, size, path in sorted(entries):
+            if self._size <= self._max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._size -= size
+
+
+artifact_store = ArtifactStore()
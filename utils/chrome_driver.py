@@ -2,18 +2,27 @@
 
 # refer: https://segmentfault.com/a/1190000018958917
 
+import queue
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import Select
 
 
 class ChromeDriver(object):
-    def __init__(self, executable_path):
+    def __init__(self, executable_path, index=0):
         # 设置窗口大小
         # self.window_width = 1200
         # self.window_height = 675
         # 设置 chromedriver 位置
         self.executable_path = executable_path
+        # index in BrowserPool
+        self.index = index
+        # sites allowed to run flash, permission is granted once per site
+        self._flash_sites = set()
         # 获取 driver
         self.driver = self.get_chrome_driver()
 
@@ -95,13 +104,19 @@ class ChromeDriver(object):
     def get_flash_url(self, web_url):
         if not web_url:
             return False
-        self.add_flash_site(web_url)
+        site = '{0.scheme}://{0.netloc}'.format(urlsplit(web_url))
+        if site not in self._flash_sites:
+            self.add_flash_site(site)
+            self._flash_sites.add(site)
         self.get(web_url)
         self.fit_content()
 
     def save_screenshot(self, filename):
         self.driver.save_screenshot(filename)
 
+    def get_screenshot_as_png(self) -> bytes:
+        return self.driver.get_screenshot_as_png()
+
     def fit_content(self):
         html = self.driver.find_element(By.TAG_NAME, "html")
         client_width = int(html.get_attribute("clientWidth"))
@@ -115,3 +130,79 @@ class ChromeDriver(object):
 
     def quit_driver(self):
         self.driver.quit()
+
+
+class BrowserPool(object):
+    """
+    long-lived chrome sessions, started on demand up to size,
+    a session is used by one thread at a time.
+    """
+
+    def __init__(self, executable_path, size=1):
+        self._executable_path = executable_path
+        self._size = max(int(size), 1)
+        self._drivers = []
+        # sessions being started
+        self._starting = 0
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        return self._size
+
+    def acquire(self) -> ChromeDriver:
+        while True:
+            try:
+                cd = self._idle.get_nowait()
+            except queue.Empty:
+                cd = None
+            if cd is not None:
+                return cd
+            with self._lock:
+                index = len(self._drivers) + self._starting
+                start = index < self._size
+                if start:
+                    self._starting += 1
+            if not start:
+                # all sessions are started, wait for one
+                cd = self._idle.get()
+                if cd is None:
+                    # a session failed to start, its slot is free again
+                    continue
+                return cd
+            try:
+                cd = ChromeDriver(self._executable_path, index=index)
+            except Exception:
+                with self._lock:
+                    self._starting -= 1
+                # wake up one waiter to start the session again, or to fail as well
+                self._idle.put(None)
+                raise
+            with self._lock:
+                self._starting -= 1
+                self._drivers.append(cd)
+            return cd
+
+    def release(self, cd):
+        self._idle.put(cd)
+
+    @contextmanager
+    def session(self):
+        cd = self.acquire()
+        try:
+            yield cd
+        finally:
+            self.release(cd)
+
+    def close(self):
+        for cd in self._drivers:
+            cd.quit_driver()
+        self._drivers = []
+        self._idle = queue.Queue()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,9 @@
+import hashlib
+
+
+def file_digest(filename, chunk_size=1024 * 1024) -> str:
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
@@ -1,51 +1,121 @@
 import os
-import socket
+import socketserver
 import threading
-from http.server import SimpleHTTPRequestHandler
-from socketserver import TCPServer
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, quote, urlencode, urlsplit
 
-from utils.path import get_filename
-from utils.template_updater import template_file, template_dir
+from utils.template_updater import template_updater
 
-PORT = 8000
 IP = "127.0.0.1"
+# 0 means an ephemeral port chosen by the os
+PORT = 0
 
-TEMPLATE_FILE = get_filename(template_file)
 
-httpd = None
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    # http.server.ThreadingHTTPServer is new in python 3.7
+    daemon_threads = True
 
 
-def server():
-    Handler = SimpleHTTPRequestHandler
-    global httpd
-    httpd = TCPServer((IP, PORT), Handler)
+class TemplateHandler(BaseHTTPRequestHandler):
+    """
+    /render?swf=<path>&w=<width>&h=<height> --> template rendered in memory
+    /swf?path=<path> --> swf file
+    only files registered by TemplateServer.page_url() are served.
+    """
 
-    print("serving at port %d " % PORT)
-    httpd.serve_forever()
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        if url.path == '/render':
+            self._render(query)
+        elif url.path == '/swf':
+            self._send_swf(query)
+        else:
+            self.send_error(404)
 
+    def _get_registered(self, query, key):
+        filename = query.get(key, [''])[0]
+        if not self.server.template_server.is_registered(filename):
+            self.send_error(404)
+            return None
+        return filename
 
-def default_page(ip, port, template_file):
-    return 'http://{0}:{1}/{2}'.format(ip, port, template_file)
+    def _render(self, query):
+        filename = self._get_registered(query, 'swf')
+        if filename is None:
+            return
+        src = '/swf?path=' + quote(filename, safe='')
+        width = int(query.get('w', ['960'])[0])
+        height = int(query.get('h', ['540'])[0])
+        data = self.server.template_server.updater.render(src, width, height).encode('utf-8')
+        self._send(data, 'text/html; charset=utf-8')
 
+    def _send_swf(self, query):
+        filename = self._get_registered(query, 'path')
+        if filename is None:
+            return
+        with open(filename, 'rb') as f:
+            data = f.read()
+        self._send(data, 'application/x-shockwave-flash')
 
-index_page = default_page(IP, PORT, TEMPLATE_FILE)
+    def _send(self, data, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
 
+    def log_message(self, format, *args):
+        # quiet, requests are made for every page
+        pass
 
-def start_server():
-    # chdir
-    os.chdir(template_dir)
-    if not is_open(IP, PORT):
-        t = threading.Thread(target=server)
-        t.start()
 
+class TemplateServer(object):
+    """
+    threaded server rendering the swf template per request,
+    nothing is written to disk and cwd is never changed, so exports can run at the same time.
+    """
 
-def is_open(ip, port):
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    try:
-        s.connect((ip, int(port)))
-        s.shutdown(2)
-        print('%d is open' % port)
-        return True
-    except:
-        print('%d is down' % port)
-        return False
+    def __init__(self, ip=IP, port=PORT, updater=template_updater):
+        self.updater = updater
+        self._files = set()
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((ip, port), TemplateHandler)
+        self._httpd.template_server = self
+        self._thread = None
+
+    @property
+    def address(self):
+        return self._httpd.server_address[:2]
+
+    def register(self, filename):
+        with self._lock:
+            self._files.add(filename)
+
+    def is_registered(self, filename):
+        with self._lock:
+            return filename in self._files
+
+    def page_url(self, filename, width, height):
+        filename = os.path.abspath(filename)
+        self.register(filename)
+        query = urlencode({'swf': filename, 'w': int(width), 'h': int(height)})
+        return 'http://{0}:{1}/render?{2}'.format(self.address[0], self.address[1], query)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+            self._thread.start()
+        return self
+
+    def shutdown(self):
+        if self._thread is not None:
+            self._httpd.shutdown()
+            self._thread = None
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.shutdown()
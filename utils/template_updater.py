@@ -1,8 +1,6 @@
-import os
 import re
 
 from utils.path import get_abs_path, get_abs_dir
-from utils.platform import is_windows
 
 template_file = '../src/template.html'
 template_file = get_abs_path(__file__, template_file)
@@ -16,31 +14,24 @@ class TemplateUpdater(object):
         self._swf_pattern = re.compile('(src=")([^"]+)(")')
         self._width_pattern = re.compile('(width[:=" ]+)(\d+)(px)')
         self._height_pattern = re.compile('(height[:=" ]+)(\d+)(px)')
+        # template read once, for render()
+        self._data = None
 
     def _read_file(self, filename):
         with open(filename, 'r') as f:
             return f.read()
 
-    def _write_file(self, filename, data):
-        with open(filename, 'w') as f:
-            f.write(data)
-
-    def __call__(self, filename, width, height):
-        # chdir
-        os.chdir(os.path.dirname(template_dir))
-        data = self._read_file(self._tempate_file)
+    def render(self, src, width, height):
+        # template with src, width and height replaced, in memory
+        if self._data is None:
+            self._data = self._read_file(self._tempate_file)
+        data = self._data
         if not data:
-            return
-        # convert to path, relative to tempate_dir
-        if is_windows():
-            new_file = os.path.abspath(filename).replace(template_dir + '\\', '').replace('\\', '/')
-        else:
-            new_file = os.path.abspath(filename).replace(template_dir + '/', '')
-        data = self._swf_pattern.sub('\g<1>%s\g<3>' % new_file, data)
+            return data
+        data = self._swf_pattern.sub(lambda m: m.group(1) + src + m.group(3), data)
         data = self._width_pattern.sub('\g<1>%s\g<3>' % width, data)
         data = self._height_pattern.sub('\g<1>%s\g<3>' % height, data)
-
-        self._write_file(self._tempate_file, data)
+        return data
 
 
 template_updater = TemplateUpdater()